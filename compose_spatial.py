@@ -19,13 +19,19 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import re
+import os
 import json
 import argparse
 import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from hashlib import blake2b
+from itertools import chain
 from pathlib import Path
 from zipfile import ZipFile
-from typing import Any, Iterator, Literal, Optional, TypedDict, NotRequired, \
-    Sequence
+from typing import Any, Callable, Iterator, Literal, Mapping, Optional, \
+    TypedDict, NotRequired, Sequence, TypeVar
 from enum import Enum
 from dataclasses import dataclass
 from http.server import HTTPServer, BaseHTTPRequestHandler
@@ -37,6 +43,9 @@ PROGRAM_DESCRIPTION = """
 """
 
 MAX_REPLACE_DEPTH = 100
+COMPOSE_CACHE_SIZE = 64
+REPLACE_DEPTH_EXCEEDED = "Maximum replace depth exceeded: please check " + \
+    "your configuration for a cycle in replace rules."
 CONFIG_FILENAME_SUFFIX = "_compose.json"
 CONFIG_FILENAME_GLOB = f"**/*{CONFIG_FILENAME_SUFFIX}"
 QLEVER_SUPPORTED_ALGORITHMS = {
@@ -48,6 +57,12 @@ QLEVER_SUPPORTED_ALGORITHMS = {
 QLEVER_DEFAULT_ALGORITHM = "s2"
 SPATIAL_SEARCH = "spatialSearch:"
 SPATIAL_SEARCH_ALL = SPATIAL_SEARCH + "all"
+# Spatial search configuration key => predicate
+SPATIAL_SEARCH_CONFIG_PREDICATES = {
+    key: SPATIAL_SEARCH + key
+    for key in ("algorithm", "left", "right", "numNearestNeighbors",
+                "maxDistance", "payload", "bindDistance")
+}
 
 
 class Mime(Enum):
@@ -125,6 +140,7 @@ QueryConfigDict = TypedDict("QueryConfigDict", {
     "spatial_searches": list[SpatialSearchDict]
 })
 FilesCache = dict[str, str]
+FileContent = TypeVar("FileContent", str, bytes)
 
 # Structure of the integrated HTTP server's configuration dict
 ServeDict = TypedDict("ServeDict", {
@@ -139,10 +155,28 @@ ServeDict = TypedDict("ServeDict", {
     "default_right": str
 })
 
+# File extension => Mime type
+FILE_EXTENSION_MIME = {
+    "html": Mime.HTML,
+    "htm": Mime.HTML,
+    "json": Mime.JSON,
+    "css": Mime.CSS,
+    "js": Mime.JS,
+    "rq": Mime.SPARQL,
+    "sparql": Mime.SPARQL
+}
+
+# Response to a request for an empty compose configuration
+BLANK_COMPOSE = b"{}"
+
+# Files served by the HTTP server may be stored by clients but have to be
+# revalidated using their ETag, because they may change on server restart
+CACHE_CONTROL = "no-cache"
+
 # Precompiled regular expressions
-FILE_EXTENSION_RE = re.compile(r'^.*\.(?P<ext>\w{2,6})$')
 SPARQL_FILE_EXT_RE = re.compile(r'\.(rq|sparql)$')
 SPARQL_VAR_RE = re.compile(r'^\?\w+$')
+TRIM_UNDERSCORE_RE = re.compile(r'^_+|_+$')
 
 
 logging.basicConfig(
@@ -156,33 +190,38 @@ def guess_type(pth: str | Path) -> Mime:
     """
     Given a file path guess the mime type based on its suffix
     """
-    m = FILE_EXTENSION_RE.match(str(pth))
-    if m:
-        match m.group("ext"):
-            case "html" | "htm":
-                return Mime.HTML
-            case "json":
-                return Mime.JSON
-            case "css":
-                return Mime.CSS
-            case "js":
-                return Mime.JS
-            case "rq" | "sparql":
-                return Mime.SPARQL
-    return Mime.PLAIN
+    s = str(pth)
+    i = s.rfind(".")
+    if i < 0:
+        return Mime.PLAIN
+    return FILE_EXTENSION_MIME.get(s[i + 1:].lower(), Mime.PLAIN)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Whether the value of an If-None-Match request header matches a given
+    entity tag. Weak comparison is used as recommended for GET requests.
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
 
 
 def get(d: dict[Any, Any], *keys: str) -> Any:
     """
     Shorthand to get values from nested dicts
     """
-    if type(d) is not dict:
+    if not isinstance(d, dict):
         return None
-    if keys == ():
+    if not keys:
         return d
     for key in keys[:-1]:
         d = d.get(key, {})
-        if type(d) is not dict:
+        if not isinstance(d, dict):
             return None
     return d.get(keys[-1], None)
 
@@ -194,6 +233,30 @@ def clean_name(name: str) -> str:
     return SPARQL_FILE_EXT_RE.sub("", Path(name).name)
 
 
+@lru_cache(maxsize=256)
+def multi_replace_pattern(keys: tuple[str, ...]) -> re.Pattern:
+    """
+    Compile a regular expression matching any of the given literal strings.
+    Longer keys are tried first, such that a key which is a prefix of another
+    key does not shadow it.
+    """
+    return re.compile("|".join(
+        re.escape(k) for k in sorted(keys, key=len, reverse=True)))
+
+
+def multi_replace(text: str, mapping: dict[str, str]) -> str:
+    """
+    Replace all occurrences of the keys of `mapping` in `text` by their
+    respective values in a single pass. In contrast to chained `str.replace`
+    calls, inserted values are not searched for other keys again.
+    """
+    mapping = {k: v for k, v in mapping.items() if k}
+    if not mapping:
+        return text
+    pattern = multi_replace_pattern(tuple(mapping))
+    return pattern.sub(lambda m: mapping[m.group(0)], text)
+
+
 def group(items: list[Any], n: int) -> list[list[Any]]:
     """
     Split a list into a list of sublists with each at most n elements
@@ -206,12 +269,14 @@ def group(items: list[Any], n: int) -> list[list[Any]]:
     ]
 
 
-def indent(text: str) -> str:
+def indent_iter(text: str) -> Iterator[str]:
     """
     Helper: given a SPARQL query, add whitespace to make it more readable.
-    This is not a universally applicable implementation.
+    This is not a universally applicable implementation. Yields the indented
+    query line by line.
     """
-    out = ""
+    # Cache indentation prefixes, depth only takes few distinct values
+    spaces: dict[int, str] = {}
     depth = 0
     blank = False
     indent_by_semicolon = 0
@@ -219,32 +284,74 @@ def indent(text: str) -> str:
         line = line.strip()
 
         # Reduce multiple blank lines to one
-        prev, blank = blank, not bool(line)
+        prev, blank = blank, not line
         if prev and blank:
             continue
 
-        if not line.startswith("#"):
-            if line.endswith("}"):
-                depth -= 2
-            if "WHERE" in line and "SELECT" not in line:
-                depth -= 8
+        if depth not in spaces:
+            spaces[depth] = " " * depth
+
+        # Blank lines and comments do not change the indentation
+        if blank or line[0] == "#":
+            yield spaces[depth] + line + "\n"
+            continue
 
-        out += (" " * depth) + line + "\n"
+        last = line[-1]
+        has_select = "SELECT" in line
+        has_where = "WHERE" in line
 
-        if not line.startswith("#"):
-            if line.endswith("{"):
-                depth += 2
-            if "SELECT" in line and "WHERE" not in line:
-                depth += 8
+        if last == "}":
+            depth -= 2
+        if has_where and not has_select:
+            depth -= 8
 
-            if indent_by_semicolon and line.endswith("."):
-                depth -= indent_by_semicolon
-                indent_by_semicolon = 0
-            elif line.endswith(";") and not indent_by_semicolon:
-                indent_by_semicolon = len(line.split()[0]) + 1
-                depth += indent_by_semicolon
+        if depth not in spaces:
+            spaces[depth] = " " * depth
+        yield spaces[depth] + line + "\n"
 
-    return out
+        if last == "{":
+            depth += 2
+        if has_select and not has_where:
+            depth += 8
+
+        if indent_by_semicolon and last == ".":
+            depth -= indent_by_semicolon
+            indent_by_semicolon = 0
+        elif last == ";" and not indent_by_semicolon:
+            indent_by_semicolon = len(line.split(None, 1)[0]) + 1
+            depth += indent_by_semicolon
+
+
+def indent(text: str) -> str:
+    """
+    Like `indent_iter`, but returns the indented query as a whole.
+    """
+    return "".join(indent_iter(text))
+
+
+@contextmanager
+def open_input(filename: str) -> Iterator[Callable[[str], str]]:
+    """
+    Open the main input directory for reading multiple files. This can be a
+    filesystem directory or a zipped one. Yields a function which retrieves
+    the content of a contained file. A ZIP file is only opened once.
+    """
+
+    pth = Path(filename)
+    assert pth.exists()
+
+    if pth.is_dir():
+        # Treat as directory
+        def read_file(sub_filename: str) -> str:
+            with open(Path(pth, sub_filename), "r") as f:
+                return f.read()
+        yield read_file
+    else:
+        # Treat as ZIP file
+        with ZipFile(pth, "r") as zf:
+            def read_zip_member(sub_filename: str) -> str:
+                return zf.read(sub_filename).decode("utf-8")
+            yield read_zip_member
 
 
 def get_file_contents(filename: str, sub_filename: str) -> str:
@@ -252,19 +359,27 @@ def get_file_contents(filename: str, sub_filename: str) -> str:
     Retrieve the content of an input file contained in the main input
     directory. This can be a filesystem directory or a zipped one.
     """
+    with open_input(filename) as read:
+        return read(sub_filename)
+
+
+def input_contains(filename: str) -> Callable[[str], bool]:
+    """
+    Returns a function which checks if a file is contained in the main input
+    directory. This can be a filesystem directory or a zipped one. For a ZIP
+    file, the list of members is only read once.
+    """
 
     pth = Path(filename)
     assert pth.exists()
 
     if pth.is_dir():
         # Treat as directory
-        with open(Path(pth, sub_filename), "r") as f:
-            return f.read()
+        return lambda sub_filename: Path(pth, sub_filename).is_file()
     else:
         # Treat as ZIP file
         with ZipFile(pth, "r") as zf:
-            with zf.open(sub_filename, "r") as f:
-                return f.read().decode("utf-8")
+            return set(zf.namelist()).__contains__
 
 
 def get_all_configs(filename: str) -> list[str]:
@@ -287,6 +402,41 @@ def get_all_configs(filename: str) -> list[str]:
                     if fn.endswith(CONFIG_FILENAME_SUFFIX)]
 
 
+def required_files(config: Any) -> list[str]:
+    """
+    List the files required by a compose config (not yet constructed) without
+    duplicates.
+    """
+    def helper() -> Iterator[str]:
+        """
+        Helper that generates filenames to be loaded
+        """
+
+        # Template file
+        template = config.get("template") or {}
+        if template.get("filename"):
+            yield template["filename"]
+
+        # Replace files
+        for t_ in template.get("replace") or []:
+            rf = t_.get("replace_file")
+            if rf:
+                yield rf
+
+        # Files for query construction
+        for _s in config.get("spatial_searches") or []:
+            gt = _s.get("group_template") or {}
+            if gt.get("filename"):
+                yield gt["filename"]
+            yield from _s.get("left") or []
+            for r in _s.get("right") or []:
+                yield r["filename"]
+
+    # Make list of required files unique, but keep the order to load
+    # them deterministically
+    return list(dict.fromkeys(helper()))
+
+
 def get_config_and_queries(filename: str, main_config: str) \
         -> tuple[QueryConfigDict, FilesCache]:
     """
@@ -296,44 +446,55 @@ def get_config_and_queries(filename: str, main_config: str) \
     """
     assert Path(filename).exists()
 
-    # Any type because the config is not yet constructed
-    config: Any = {}
-
     files: FilesCache = {}
+    with open_input(filename) as read:
+        config = json.loads(read(main_config))
+        for sub_filename in required_files(config):
+            files[sub_filename] = read(sub_filename)
 
-    def required_files_from_config() -> set[str]:
-        def helper() -> Iterator[str]:
-            """
-            Helper that generates filenames to be loaded
-            """
+    return (config, files)
 
-            # Template file
-            yield get(config, "template", "filename")
 
-            # Replace files
-            t = get(config, "template", "replace")
-            if t:
-                for t_ in t:
-                    rf = get(t_, "replace_file")
-                    if rf:
-                        yield rf
+class LazyFilesCache(Mapping[str, FileContent]):
+    """
+    Read-only mapping of file names to file contents, where files are only
+    registered at first and read when they are accessed for the first time.
+    Only registered files can be accessed. The contents are either all `str`
+    or all `bytes`, depending on the loaders.
+    """
 
-            # Files for query construction
-            s = get(config, "spatial_searches")
-            for _s in s:
-                yield get(_s, "group_template", "filename")
-                yield from get(_s, "left")
-                for r in get(_s, "right"):
-                    yield r["filename"]
+    def __init__(self):
+        self.__loaders: dict[str, Callable[[], FileContent]] = {}
+        self.__contents: dict[str, FileContent] = {}
 
-        # Make list of required files unique
-        return set(helper())
+    def register(self, fn: str, loader: Callable[[], FileContent]):
+        """
+        Make the file `fn` available. Its content is retrieved by calling
+        `loader` on first access.
+        """
+        self.__loaders[fn] = loader
 
-    config = json.loads(get_file_contents(filename, main_config))
-    for sub_filename in required_files_from_config():
-        files[sub_filename] = get_file_contents(filename, sub_filename)
+    def put(self, fn: str, content: FileContent):
+        """
+        Make the file `fn` available with an already known content.
+        """
+        self.__loaders[fn] = partial(type(content), content)
+        self.__contents[fn] = content
 
-    return (config, files)
+    def __getitem__(self, fn: str) -> FileContent:
+        if fn not in self.__contents:
+            # Raises KeyError for unknown files
+            self.__contents[fn] = self.__loaders[fn]()
+        return self.__contents[fn]
+
+    def __contains__(self, fn: object) -> bool:
+        return fn in self.__loaders
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__loaders)
+
+    def __len__(self) -> int:
+        return len(self.__loaders)
 
 
 @dataclass
@@ -358,19 +519,19 @@ class GroupTemplate:
             d["patterns"]["queries"],
             d["patterns"]["select"])
 
-    def compose(self, files: dict[str, str],
+    def compose(self, files: Mapping[str, str],
                 queries: list[tuple[str, str]], select: list[str]) -> str:
-        select_str = "\n".join(set(s.strip() for s in select))
-        queries_str = ""
-        for qname, query in queries:
-            queries_str = queries_str + "\n" + \
-                "# --- Begin of `" + qname + "`\n" + query + \
-                "\n# --- End of `" + qname + "`\n"
+        # Remove duplicates, but keep the order for reproducible output
+        select_str = "\n".join(dict.fromkeys(s.strip() for s in select))
+        queries_str = "".join(
+            f"\n# --- Begin of `{qname}`\n{query}\n# --- End of `{qname}`\n"
+            for qname, query in queries)
         assert self.filename in files, \
             f"Group template '{self.filename}' is missing"
-        return files[self.filename] \
-            .replace(self.queries_pattern, queries_str) \
-            .replace(self.select_pattern, select_str)
+        return multi_replace(files[self.filename], {
+            self.queries_pattern: queries_str,
+            self.select_pattern: select_str
+        })
 
 
 @dataclass
@@ -379,9 +540,9 @@ class ProvidedValues:
     values: list[str]
 
     def __post_init__(self):
-        assert re.match(
-            r'^\?\w+$', self.variable), "Variable for values must begin " + \
-            "with '?' and contain only alphanumeric chars and underscores"
+        assert SPARQL_VAR_RE.match(self.variable), \
+            "Variable for values must begin with '?' and contain only " + \
+            "alphanumeric chars and underscores"
         assert len(self.values), "Provided values needs at least one value"
 
     @staticmethod
@@ -474,7 +635,8 @@ class SpatialSearchConfig:
         config["bindDistance"] = bind
 
         config_pairs = ' ;\n'.join(
-            f"{SPATIAL_SEARCH}{key} {val}" for key, val in config.items()
+            f"{SPATIAL_SEARCH_CONFIG_PREDICATES[key]} {val}"
+            for key, val in config.items()
         ) + " ."
         return f"""
         SERVICE {SPATIAL_SEARCH} {{
@@ -500,12 +662,17 @@ class RightShard:
             if p == "<all>" or p == SPATIAL_SEARCH_ALL:
                 seen_all = True
             else:
-                assert re.match(r'^\?\w+$', p), \
+                assert SPARQL_VAR_RE.match(p), \
                     f"Invalid payload value '{p}' ('<all>', " + \
                     f"'{SPATIAL_SEARCH_ALL}' or a variable expected)"
         if seen_all:
             # Clean up
             self.payload = [SPATIAL_SEARCH_ALL]
+        # Name without file extension, used for variable names
+        self.name = clean_name(self.filename)
+        # For fast membership tests
+        self._payload_set = frozenset(self.payload)
+        self._includes_all = seen_all
 
     @staticmethod
     def from_config(d: RightShardDict) -> 'RightShard':
@@ -515,7 +682,7 @@ class RightShard:
         return ", ".join(self.payload)
 
     def includes_variable(self, var: str) -> bool:
-        return var in self.payload or self.payload == [SPATIAL_SEARCH_ALL]
+        return self._includes_all or var in self._payload_set
 
 
 @dataclass
@@ -577,62 +744,72 @@ class SpatialSearch:
     def apply_name_template(self, lname: str, rname: str) -> str:
         type_ = str(self.config)
         # re.sub(r'_+', '_', re.sub(r'\W', '_', str(self.config)))
-        qname = self.name_template \
-            .replace(self.name_type_pattern, type_) \
-            .replace(self.name_left_pattern, lname) \
-            .replace(self.name_right_pattern, rname)
-        return re.sub(r'(^_+)|(_+$)', '', qname)
-
-    def compose_single(self, files: dict[str, str], left: str,
-                       right: RightShard) -> tuple[str, str, str]:
-        lname = clean_name(left)
-        rname = clean_name(right.filename)
+        qname = multi_replace(self.name_template, {
+            self.name_type_pattern: type_,
+            self.name_left_pattern: lname,
+            self.name_right_pattern: rname
+        })
+        if qname.startswith("_") or qname.endswith("_"):
+            return TRIM_UNDERSCORE_RE.sub("", qname)
+        return qname
+
+    def compose_single(self, files: Mapping[str, str], left: str,
+                       right: RightShard, lname: Optional[str] = None) \
+            -> tuple[str, str, str]:
+        if lname is None:
+            lname = clean_name(left)
+        rname = right.name
 
         qname = self.apply_name_template(lname, rname)
         query, original = files[right.filename], files[right.filename]
 
-        assert "?" + rname in query, f"Right variable ?{rname} is not defined"
-        assert "?" + lname + "_centroid" not in query, \
-            f"Centroid ?{lname}_centroid is defined, but should not be"
+        # Variable names used below
+        rvar = "?" + rname
+        lcentroid = f"?{lname}_centroid"
+        rcentroid = f"?{rname}_centroid"
+        count_var = f"?count_{rname}"
+        dist_var = f"?dist_{qname}"
+
+        assert rvar in query, f"Right variable {rvar} is not defined"
+        assert lcentroid not in query, \
+            f"Centroid {lcentroid} is defined, but should not be"
 
         for pv in self.provided_values:
             query = pv.compose(query, qname)
 
-        if f"?{rname}_centroid" not in original:
+        if rcentroid not in original:
             query = f"""
                 {query}
 
-                ?{rname} geo:hasCentroid/geo:asWKT ?{rname}_centroid .
+                {rvar} geo:hasCentroid/geo:asWKT {rcentroid} .
             """
 
-        count_var = f"?count_{rname}"
-        if count_var not in original and (
-                right.includes_variable(count_var)
-                or count_var in right.payload):
+        if count_var not in original and right.includes_variable(count_var):
             query = f"""
                 {query}
-                BIND(COUNT(*) AS ?count_{rname})
+                BIND(COUNT(*) AS {count_var})
             """
 
         # Order is important here, the spatial join may not be
         # inside the subquery
         query = self.config.compose(
-            f"?{lname}_centroid", f"?{rname}_centroid", f"?dist_{qname}",
-            right.payload, query)
+            lcentroid, rcentroid, dist_var, right.payload, query)
 
-        select = f"\n# Select expressions for `{qname}`:\n"
-        for selector in self.add_selectors:
-            select += selector \
-                .replace(self.dist_pattern, f"?dist_{qname}") \
-                .replace(self.count_pattern, f"?count_{rname}") \
-                .replace(self.centroid_pattern, f"?{rname}_centroid") \
-                + "\n"
+        subs = {
+            self.dist_pattern: dist_var,
+            self.count_pattern: count_var,
+            self.centroid_pattern: rcentroid
+        }
+        select = f"\n# Select expressions for `{qname}`:\n" + "".join(
+            multi_replace(selector, subs) + "\n"
+            for selector in self.add_selectors)
 
         return (qname, query, select)
 
-    def compose_left(self, files: dict[str, str], left: str) \
-            -> tuple[str, str]:
-        lname = clean_name(left)
+    def compose_left(self, files: Mapping[str, str], left: str,
+                     lname: Optional[str] = None) -> tuple[str, str]:
+        if lname is None:
+            lname = clean_name(left)
         qname = lname + "_"
         query = f"""
             {{
@@ -644,27 +821,28 @@ class SpatialSearch:
         """
         return qname, query
 
-    def compose(self, files: dict[str, str]) -> tuple[str, str]:
+    def compose(self, files: Mapping[str, str]) -> tuple[str, str]:
         """
         Will create subqueries for each combination of left and right.
         Each will contain one left query and up to group_size right queries.
         """
         collected_groups = []
+        # Grouping against overloading the query engine
+        grouped = []
+        if self.group_size:
+            grouped = group(self.right, self.group_size)
+        else:
+            grouped = [self.right]
         for left in self.left:
-            # Grouping against overloading the query engine
-            grouped = []
-            if self.group_size:
-                grouped = group(self.right, self.group_size)
-            else:
-                grouped = [self.right]
+            lname = clean_name(left)
             for group_ in grouped:
                 collected_queries = [
-                    self.compose_left(files, left)
+                    self.compose_left(files, left, lname)
                 ]
                 collected_select = []
                 for right in group_:
                     qname, query, select = self.compose_single(
-                        files, left, right)
+                        files, left, right, lname)
                     collected_queries.append((qname, query))
                     collected_select.append(select)
                 collected_groups.append(
@@ -689,6 +867,10 @@ class ReplaceRule:
             "You must provide 'replace' or 'replace_file' to a " + \
             "replace rule, not none or both"
 
+        self._pattern = re.compile(self.search)
+        # (Contents of replace_file, escaped contents)
+        self._escaped_replace: Optional[tuple[str, str]] = None
+
     @staticmethod
     def from_config(d: ReplaceRuleDict) -> 'ReplaceRule':
         return ReplaceRule(
@@ -698,21 +880,27 @@ class ReplaceRule:
         )
 
     def can_be_replaced(self, text: str) -> bool:
-        return bool(re.search(self.search, text))
+        return self._pattern.search(text) is not None
 
-    def apply(self, files: dict[str, str], text: str) -> str:
+    def apply(self, files: Mapping[str, str], text: str) -> str:
         "Apply the replace rule without recursion"
         replace = self.replace
         if not replace:
             # For type checker
             assert self.replace_file is not None, \
                 "A replace rule requires either replace_file or replace"
-            # escape to not interpret \1 etc.
-            replace = files[self.replace_file].replace('\\', '\\\\')
+            # escape to not interpret \1 etc., cached as long as the file
+            # contents are the same object
+            contents = files[self.replace_file]
+            if self._escaped_replace is None or \
+                    self._escaped_replace[0] is not contents:
+                self._escaped_replace = (
+                    contents, contents.replace('\\', '\\\\'))
+            replace = self._escaped_replace[1]
         # For type checker
         assert replace is not None, \
             "A replace rule requires either replace_file or replace"
-        return re.sub(self.search, replace, text)
+        return self._pattern.sub(replace, text)
 
 
 @dataclass
@@ -730,8 +918,8 @@ class Template:
             [ReplaceRule.from_config(r) for r in d.get("replace", [])]
         )
 
-    def compose(self, files: dict[str, str], groups: list[tuple[str, str]]) \
-            -> str:
+    def compose(self, files: Mapping[str, str],
+                groups: list[tuple[str, str]]) -> str:
         result = files[self.filename]
 
         # Insert spatial searches into template
@@ -741,24 +929,34 @@ class Template:
             if pattern not in groups_dict:
                 groups_dict[pattern] = []
             groups_dict[pattern].append(value)
-        for pattern, values in groups_dict.items():
-            value = "\n".join(values)
-            result = result.replace(pattern, value)
-
-        # Apply recursive replacement sequences
+        result = multi_replace(result, {
+            pattern: "\n".join(values)
+            for pattern, values in groups_dict.items()
+        })
+
+        # Apply recursive replacement sequences: each rule is applied until it
+        # no longer matches. A rule only needs to be checked again if another
+        # rule has changed the result since it was last found not to match.
         # Max depth to avoid endless loop if search matches its own replacement
+        # or rules replace each other cyclically
+        version = 0
+        clean_at: list[Optional[int]] = [None] * len(self.replace_rules)
         for _ in range(MAX_REPLACE_DEPTH):
-            replaced = False
-            for r in self.replace_rules:
-                if r.can_be_replaced(result):
-                    replaced = True
+            for i, r in enumerate(self.replace_rules):
+                if clean_at[i] == version:
+                    continue
+                for _ in range(MAX_REPLACE_DEPTH):
+                    if not r.can_be_replaced(result):
+                        break
                     result = r.apply(files, result)
-            if not replaced:
+                    version += 1
+                else:
+                    raise RecursionError(REPLACE_DEPTH_EXCEEDED)
+                clean_at[i] = version
+            if all(c == version for c in clean_at):
                 break
         else:
-            raise RecursionError(
-                "Maximum replace depth exceeded: please check your " +
-                "configuration for a cycle in replace rules.")
+            raise RecursionError(REPLACE_DEPTH_EXCEEDED)
 
         return result
 
@@ -783,7 +981,7 @@ class QueryConfig:
             [SpatialSearch.from_config(s) for s in d["spatial_searches"]]
         )
 
-    def compose(self, files: dict[str, str]) -> str:
+    def compose(self, files: Mapping[str, str]) -> str:
         groups: list[tuple[str, str]] = []
         for s in self.spatial_searches:
             groups.append(s.compose(files))
@@ -798,12 +996,12 @@ def cli_main(_input: str, _main_config: str, _outfile: Optional[str]):
     _config, _files = get_config_and_queries(
         _input, _main_config)
     config = QueryConfig.from_config(_config)
-    result = indent(config.compose(_files))
     if _outfile is not None:
+        # Write line by line to avoid an additional copy of the whole query
         with open(_outfile, "w") as f:
-            f.write(result)
+            f.writelines(indent_iter(config.compose(_files)))
     else:
-        print(result, end="")
+        print(indent(config.compose(_files)), end="")
 
 
 class ComposeSpatialHTTPRequestHandler(BaseHTTPRequestHandler):
@@ -813,17 +1011,33 @@ class ComposeSpatialHTTPRequestHandler(BaseHTTPRequestHandler):
     defined below.
     """
 
-    def __compose_response(self, code: int, ctype: Mime, body: str):
+    def __compose_response(self, code: int, ctype: Mime, body: str | bytes,
+                           headers: Optional[dict[str, str]] = None):
         # For the type checker
         assert isinstance(self.server, ComposeSpatialHTTPServer)
         if self.server.verbose:
             logger.info("Response %d %s", code, ctype)
 
+        if isinstance(body, str):
+            body = body.encode()
         self.send_response(code)
         self.send_header("Content-type", ctype.value)
         self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __not_modified_response(self, headers: dict[str, str]):
+        # For the type checker
+        assert isinstance(self.server, ComposeSpatialHTTPServer)
+        if self.server.verbose:
+            logger.info("Response 304 Not Modified")
+
+        self.send_response(304)
+        for key, value in headers.items():
+            self.send_header(key, value)
         self.end_headers()
-        self.wfile.write(body.encode())
 
     def do_GET(self):
         """
@@ -842,10 +1056,17 @@ class ComposeSpatialHTTPRequestHandler(BaseHTTPRequestHandler):
             pth = "/index.html"
 
         if pth == "/blank_compose.json":
-            self.__compose_response(200, Mime.JSON, "{}")
+            self.__compose_response(200, Mime.JSON, BLANK_COMPOSE)
         elif self.server.knows(pth[1:]):
-            self.__compose_response(
-                200, guess_type(pth), self.server.get(pth[1:]))
+            # Clients may reuse their stored copy if the ETag still matches
+            etag = self.server.get_etag(pth[1:])
+            headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+            if etag_matches(self.headers.get("If-None-Match"), etag):
+                self.__not_modified_response(headers)
+            else:
+                self.__compose_response(
+                    200, guess_type(pth), self.server.get_encoded(pth[1:]),
+                    headers)
         else:
             self.__compose_response(404, Mime.PLAIN, "Not Found")
 
@@ -874,13 +1095,12 @@ class ComposeSpatialHTTPRequestHandler(BaseHTTPRequestHandler):
             return
 
         try:
-            data = json.loads(self.rfile.read(
-                int(self.headers['Content-Length'])).decode("utf-8"))
-            res = self.server.compose(data)
+            res = self.server.compose_request(self.rfile.read(
+                int(self.headers['Content-Length'])))
             self.__compose_response(200, Mime.SPARQL, res)
         except Exception as e:
-            res = type(e).__name__ + ": " + str(e)
-            if type(e) is KeyError:
+            res = f"{type(e).__name__}: {e}"
+            if isinstance(e, KeyError):
                 res += " - please make sure to add at least one item " + \
                     "to this mandatory field"
             logger.error(res)
@@ -891,9 +1111,10 @@ class ComposeSpatialHTTPRequestHandler(BaseHTTPRequestHandler):
 class ComposeSpatialHTTPServer(HTTPServer):
     """
     A subclass of HTTPServer that implements custom logic for the internal
-    web app. Mainly it loads all files required for the web app and compose
-    tasks received from it into in-memory dictionaries. Thus a request is fast
-    and cannot access files it is not intended to access.
+    web app. Mainly it registers all files required for the web app and
+    compose tasks received from it in in-memory caches. The files are read on
+    first access and kept in memory afterwards. Thus a request is fast and
+    cannot access files it is not intended to access.
 
     Fields:
 
@@ -911,52 +1132,77 @@ class ComposeSpatialHTTPServer(HTTPServer):
     All attributes are immutable after creation.
     """
 
-    __pages: FilesCache
-    __files: FilesCache
+    __pages: LazyFilesCache[bytes]
+    __files: LazyFilesCache[str]
+    __encoded: dict[str, bytes]
+    __etags: dict[str, str]
+    __compose_cache: OrderedDict[bytes, bytes]
     __config: ServeDict
 
     def __get_pages(self):
         """
-        Internal helper to load web app resources into a dict. These do not
-        come from `_input` but must be relative to the program's location.
+        Internal helper to register web app resources. These do not come from
+        `_input` but must be relative to the program's location. They are only
+        served, so they are kept as raw bytes.
         """
-        prog_dir = Path(__file__).parent
-        compose_dir = prog_dir / "compose"
-        for pth in compose_dir.rglob("**/*"):
-            if not pth.is_file():
-                continue
-            with open(pth, "r") as f:
-                self.__pages[str(pth.relative_to(compose_dir))] = f.read()
+        compose_dir = os.path.join(os.path.dirname(__file__), "compose")
+        # Walk the directory using the file type information returned by
+        # scandir instead of an additional stat call per file
+        stack = [compose_dir]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        rel = os.path.relpath(entry.path, compose_dir)
+                        self.__pages.register(
+                            rel, Path(entry.path).read_bytes)
 
     def __init__(self, _input: str, _main_config: str, _serve: str):
         logger.info("Compose Spatial HTTP Server: Preparing...")
 
         # Get pages and resources (in-memory cache for HTTP request processing)
-        self.__pages: FilesCache = {}
+        self.__pages = LazyFilesCache[bytes]()
         self.__get_pages()
+        self.__encoded: dict[str, bytes] = {}
+        self.__etags: dict[str, str] = {}
+        self.__compose_cache: OrderedDict[bytes, bytes] = OrderedDict()
 
         # Load server configuration
         self.__config: ServeDict = json.loads(
             get_file_contents(_input, _serve))
 
-        # Load all files into memory according to server and main config
+        # Register all files according to server and main config
         all_configs = get_all_configs(_input)
         if _main_config not in all_configs:
             all_configs.append(_main_config)
 
-        self.__files: FilesCache = {}
+        self.__files = LazyFilesCache[str]()
+        contains = input_contains(_input)
+
+        def register(filename: str):
+            """
+            Files are read lazily, so check that they exist right away
+            """
+            assert contains(filename), \
+                f"File '{filename}' not found in input '{_input}'"
+            self.__files.register(
+                filename, partial(get_file_contents, _input, filename))
+
         for config_fn in all_configs:
-            _, c_files = get_config_and_queries(_input, config_fn)
-            self.__files |= c_files
-
-        retrieve_files_list = all_configs + \
-            list(self.__config["templates"]) + \
-            list(self.__config["group_templates"]) + \
-            list(self.__config["shards"]) + \
-            list(self.__config["replace_files"])
-        for filename in retrieve_files_list:
+            config_str = get_file_contents(_input, config_fn)
+            self.__files.put(config_fn, config_str)
+            for filename in required_files(json.loads(config_str)):
+                register(filename)
+
+        # Files already registered, e.g. by multiple categories, are skipped
+        for filename in chain(self.__config["templates"],
+                              self.__config["group_templates"],
+                              self.__config["shards"],
+                              self.__config["replace_files"]):
             if filename not in self.__files:
-                self.__files[filename] = get_file_contents(_input, filename)
+                register(filename)
 
         def get_desc(fn: str) -> str:
             """
@@ -964,11 +1210,11 @@ class ComposeSpatialHTTPServer(HTTPServer):
             a comment, it is assumed to contain a description of what the query
             shard does
             """
-            v = self.__files[fn]
             description = ""
             if fn.endswith(".rq") or fn.endswith(".sparql"):
-                lines = v.splitlines()
-                if not v.strip() or not lines:
+                # Only the first line is needed, the file is not split
+                lines = self.__files[fn].partition("\n")[0].splitlines()
+                if not lines:
                     return description
                 head = lines[0].strip()
                 if head.startswith("#"):
@@ -1002,9 +1248,15 @@ class ComposeSpatialHTTPServer(HTTPServer):
                 shards, self.__config["default_right"])
         }
 
-        self.__files["configs.json"] = json.dumps(configs)
-        self.__files["default_input"] = _main_config
-        self.__files["selects.json"] = json.dumps(selects)
+        # The generated files are final, so they are encoded right away
+        generated = {
+            "configs.json": json.dumps(configs, separators=(",", ":")),
+            "default_input": _main_config,
+            "selects.json": json.dumps(selects, separators=(",", ":"))
+        }
+        for fn, content in generated.items():
+            self.__files.put(fn, content)
+            self.__encoded[fn] = content.encode()
 
         super().__init__(self.bind_address, ComposeSpatialHTTPRequestHandler)
 
@@ -1033,7 +1285,34 @@ class ComposeSpatialHTTPServer(HTTPServer):
         """
         if self.verbose:
             logger.info("Reading file %s", fn)
-        return self.__files.get(fn, None) or self.__pages.get(fn, None) or ""
+        content = self.__files.get(fn, None)
+        if not content and fn in self.__pages:
+            return self.__pages[fn].decode()
+        return content or ""
+
+    def get_encoded(self, fn: str) -> bytes:
+        """
+        Like `get`, but returns the UTF-8 encoded file. The encoding is only
+        computed once per file, because the files do not change. Web app
+        resources are returned as read from disk.
+        """
+        if self.verbose:
+            logger.info("Reading file %s", fn)
+        if fn not in self.__encoded:
+            content = self.__files.get(fn, None)
+            self.__encoded[fn] = content.encode() if content \
+                else self.__pages.get(fn, b"")
+        return self.__encoded[fn]
+
+    def get_etag(self, fn: str) -> str:
+        """
+        The entity tag of a cached file for conditional GET requests. Like the
+        encoding, it is only computed once per file.
+        """
+        if fn not in self.__etags:
+            digest = blake2b(self.get_encoded(fn), digest_size=8).hexdigest()
+            self.__etags[fn] = f"\"{digest}\""
+        return self.__etags[fn]
 
     def compose(self, data: QueryConfigDict) -> str:
         """
@@ -1044,6 +1323,26 @@ class ComposeSpatialHTTPServer(HTTPServer):
         qconfig = QueryConfig.from_config(data)
         return indent(qconfig.compose(self.__files))
 
+    def compose_request(self, body: bytes) -> bytes:
+        """
+        Answer a compose query given the raw JSON request body. Because the
+        files do not change, the encoded results for the most recent distinct
+        requests are cached.
+        """
+        key = blake2b(body, digest_size=16).digest()
+        if key in self.__compose_cache:
+            if self.verbose:
+                logger.info("Using cached compose result")
+            self.__compose_cache.move_to_end(key)
+            return self.__compose_cache[key]
+
+        # json decodes UTF-8 bytes itself
+        result = self.compose(json.loads(body)).encode()
+        self.__compose_cache[key] = result
+        if len(self.__compose_cache) > COMPOSE_CACHE_SIZE:
+            self.__compose_cache.popitem(last=False)
+        return result
+
 
 def serve_main(_input: str, _main_config: str, _serve: str):
     """
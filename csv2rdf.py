@@ -22,10 +22,11 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import csv
 import re
 import json
+from sys import intern
 from dataclasses import dataclass, field
 from typing import Callable, Iterator, Optional, Sequence
-from dataset import PREFIXES, Dataset, Prefix, Triple, next_id, TYPE, MEMBER, \
-    UNPROBLEMATIC_PREDICATE, add_datatype
+from dataset import PREFIXES, Dataset, Prefix, Triple, TYPE, MEMBER, \
+    UNPROBLEMATIC_PREDICATE, GLOBAL_COUNTER, add_datatype
 import argparse
 import logging
 
@@ -55,11 +56,49 @@ ExtraTripleCallback = Optional[Callable[[
     'CSVDataset', str, dict[str, str]], Iterator[Triple]]
 ]  # Dataset, Subject, Row
 CSVColumnMapping = dict[str, Optional[str]]
-CSVValuesMappingRule = tuple[str, str | Callable[[re.Match], str]]
+CSVValuesMappingRule = tuple[
+    str | re.Pattern, str | Callable[[re.Match], str]
+]
 CSVValuesMappingRules = Sequence[CSVValuesMappingRule]
 CSVValuesMapping = dict[
     str, tuple[CSVValuesMappingRules, bool]
 ]  # Col after Mapping -> ([(ReSearch, ReReplace),...], AddDatatype)
+CompiledValuesMappingRules = list[
+    tuple[re.Pattern, str | Callable[[re.Match], str]]
+]
+
+# A search pattern which matches exactly one literal value, like "^0$"
+LITERAL_RULE_REGEX = re.compile(r"\^(\w*)\$")
+
+
+def compile_values_mapping(values_mapping: CSVValuesMapping) \
+        -> dict[str, tuple[CompiledValuesMappingRules, bool]]:
+    """
+    Compiles the search patterns of all replace rules in a values mapping,
+    such that they do not need to be looked up again for every cell.
+    """
+    return {
+        col: ([(re.compile(search), replace) for search, replace in rules],
+              datatype)
+        for col, (rules, datatype) in values_mapping.items()
+    }
+
+
+def values_lookup_table(rules: CompiledValuesMappingRules) -> dict[str, str]:
+    """
+    Precomputes the result of applying all replace rules for each value which
+    is matched literally by one of the rules (like `^0$` for enumerations).
+    Other values still need to go through the rules one by one.
+    """
+    table: dict[str, str] = {}
+    for search, _ in rules:
+        m = LITERAL_RULE_REGEX.fullmatch(search.pattern)
+        if m:
+            value = m[1]
+            for s, r in rules:
+                value = s.sub(r, value)
+            table[m[1]] = value
+    return table
 
 
 @Dataset.register
@@ -127,76 +166,141 @@ class CSVDataset(Dataset):
         Converts a CSV file to RDF triples. See: Dataset.rdf
         """
         content_iter = self.content()
-        reader = csv.DictReader(content_iter,
-                                delimiter=self.csv_separator,
-                                quotechar=self.csv_quote)
+        values_mapping = compile_values_mapping(self.values_mapping)
+        reader = csv.reader(content_iter,
+                            delimiter=self.csv_separator,
+                            quotechar=self.csv_quote)
+
+        # Like csv.DictReader: the first non-empty row contains the col names
+        fieldnames: list[str] = []
+        for fieldnames in reader:
+            if fieldnames:
+                break
 
         # Check column mappings
-        if WARN_MISSING_COL_MAPPING and reader.fieldnames:
-            for col in reader.fieldnames:
+        if WARN_MISSING_COL_MAPPING:
+            for col in fieldnames:
                 if col not in self.column_mapping:
                     logger.warning(
                         "Dataset %s. Missing column mapping for %s",
                         self.dataset, col)
 
+        # Like csv.DictReader, a column name which occurs more than once in
+        # the header keeps the position of its first and the value of its
+        # last occurrence. Maps each name to the index of its cell.
+        col_idx = {col: i for i, col in enumerate(fieldnames)}
+        col_names = list(col_idx)
+        picks: Optional[list[int]] = None
+        if len(col_names) < len(fieldnames):
+            picks = list(col_idx.values())
+
+        # Resolve the column and values mappings once per column. For each
+        # column name: (final predicate or None if the column should be
+        # skipped, compiled replace rules, precomputed results, add datatype?)
+        clean_prefix = self.clean_prefix
+        col_info: list[tuple[Optional[str], CompiledValuesMappingRules,
+                             dict[str, str], bool]] = []
+        for col in col_names:
+            pred = self.column_mapping.get(col, col)
+            if pred is None:
+                col_info.append((None, [], {}, True))
+                continue
+            rules, datatype = values_mapping.get(pred, ([], True))
+
+            # Clean up predicates
+            if ":" not in pred:
+                pred = clean_prefix + pred
+            if not UNPROBLEMATIC_PREDICATE.fullmatch(pred):
+                pred = "\"" + pred + "\""
+            col_info.append((intern(pred), rules, values_lookup_table(rules),
+                             datatype))
+
+        # Position and replace rules of the primary column
+        primary_idx = -1
+        primary_rules: CompiledValuesMappingRules = []
+        if self.primary_col and fieldnames:
+            assert self.primary_col in fieldnames, \
+                f"Dataset {self.dataset}: primary column " + \
+                f"'{self.primary_col}' not found"
+            primary_idx = col_idx[self.primary_col]
+            primary_rules = col_info[col_names.index(self.primary_col)][1]
+
+        # These do not change while processing the rows. Strings that are
+        # repeated in many triples are interned.
+        primary_prefix = self.primary_prefix
+        type_str = intern(self.type_str)
+        parent = intern(self.parent) if self.parent else self.parent
+        callback = self.extra_triple_callback
+        n_cols = len(fieldnames)
+        next_number = GLOBAL_COUNTER.__next__
+        warned_extra_cells = False
+
         # Process entries of file
         for row in reader:
+            if not row:
+                continue
+
             # Each row corresponds to one RDF subject
             subj = ""
-            if self.primary_col:
-                # Also apply col + values mapping to primary_col if applicable
-                primary_col = self.primary_col
-                if primary_col in self.column_mapping:
-                    primary_col = self.column_mapping[primary_col]
-
-                primary_col_val = row[self.primary_col]
-                if primary_col in self.values_mapping:
-                    for search, replace in \
-                            self.values_mapping[primary_col][0]:
-                        primary_col_val = re.sub(
-                            search, replace, primary_col_val)
+            if primary_idx >= 0:
+                # Also apply col + values mapping to primary_col if applicable.
+                # A row which is too short has an empty primary_col.
+                primary_col_val = row[primary_idx] \
+                    if primary_idx < len(row) else ""
+                for search, replace in primary_rules:
+                    primary_col_val = search.sub(replace, primary_col_val)
 
                 # Use as subject
-                subj = f"{self.primary_prefix}{primary_col_val}"
+                subj = primary_prefix + primary_col_val
             else:
                 # Generate subject because the data does not have a primary
-                subj = f"{self.primary_prefix}_{next_id()}"
+                subj = primary_prefix + "_" + str(next_number())
 
             # Emit general triples on the subject (type and parent)
-            yield (subj, TYPE, f"{self.type_str}")
-            if self.parent:
-                yield (subj, MEMBER, self.parent)
-
-            for col, obj in row.items():
-                # Do not emit triples with empty object
-                if obj == "" or obj is None:
+            yield (subj, TYPE, type_str)
+            if parent:
+                yield (subj, MEMBER, parent)
+
+            # Cells beyond the header have no column name and are not
+            # converted
+            if len(row) > n_cols and not warned_extra_cells:
+                logger.warning(
+                    "Dataset %s. Row with %d cells, but only %d columns. " +
+                    "The extra cells are ignored.",
+                    self.dataset, len(row), n_cols)
+                warned_extra_cells = True
+
+            cells = row
+            if picks is not None:
+                cells = [row[i] if i < len(row) else "" for i in picks]
+
+            for (pred, rules, table, datatype), obj in zip(col_info, cells):
+                # Do not emit triples with empty object or skipped column
+                if obj == "" or pred is None:
                     continue
 
-                # Predicate name / Column mapping
-                pred = col
-                if col in self.column_mapping:
-                    pred = self.column_mapping[col]
-                    if pred is None:
-                        continue
-
-                # Apply regular expression replace to values
-                datatype = True
-                if pred in self.values_mapping:
-                    pairs, datatype = self.values_mapping[pred]
-                    for search, replace in pairs:
-                        obj = re.sub(search, replace, obj)
-
-                # Clean up predicates
-                if ":" not in pred:
-                    pred = f"{self.clean_prefix}{pred}"
-                if not UNPROBLEMATIC_PREDICATE.match(pred):
-                    pred = f"\"{pred}\""
+                # Apply regular expression replace to values, unless the
+                # result is already known
+                mapped = table.get(obj) if table else None
+                if mapped is not None:
+                    obj = mapped
+                else:
+                    for search, replace in rules:
+                        obj = search.sub(replace, obj)
 
                 # Encode object. Emit triple
                 yield (subj, pred, add_datatype(obj) if datatype else obj)
 
-            if self.extra_triple_callback:
-                yield from self.extra_triple_callback(self, subj, row)
+            if callback is not None:
+                # The callback expects the raw row as a dictionary. Like for
+                # csv.DictReader, missing cells are None and extra cells are
+                # given as a list under the key None.
+                raw_row = dict(zip(fieldnames, row))
+                if len(row) < n_cols:
+                    raw_row |= dict.fromkeys(fieldnames[len(row):])
+                elif len(row) > n_cols:
+                    raw_row[None] = row[n_cols:]  # type: ignore
+                yield from callback(self, subj, raw_row)
 
 
 def parse_arguments(argv: Optional[Sequence[str]]) -> argparse.Namespace:
@@ -19,68 +19,130 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-import json
+import os
+import codecs
+from json.encoder import encode_basestring_ascii
 import re
 import subprocess
 import logging
 import bz2
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass, field, InitVar
+from functools import lru_cache
+from itertools import count
 from typing import Iterator, Optional
 from abc import ABC, abstractmethod
 from urllib.parse import urlparse
-from io import TextIOWrapper
 
 Triple = tuple[str, str, str]
 
 # Collection of regexes to detect datatypes etc.
-UNPROBLEMATIC_PREDICATE = re.compile(r"^(\w+:)?\w+$")
-UNPROBLEMATIC_PREFIX = re.compile(r"^\w+:\w*$")
-UNPROBLEMATIC_DATASET = re.compile(r"^\w+$")
-INT_REGEX = re.compile(r'^-?\d+$')
-FLOAT_REGEX = re.compile(r'^-?\d+(\.\d+)?$')
-DATE_REGEX_DD_MM_YYYY = re.compile(
-    r'^(?P<day>\d{2})\.(?P<month>\d{2})\.(?P<year>\d{4})$')
-DATE_REGEX_YYYY_MM_DD = re.compile(
-    r'^(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d{2})$')
-DATETIME_ISO_REGEX = re.compile(
-    r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?Z'
-)
+# Use with fullmatch: "$" would also accept a trailing line break
+UNPROBLEMATIC_PREDICATE = re.compile(r"(\w+:)?\w+")
 POINT_REGEX = re.compile(
     r'\s*[Pp][Oo][Ii][Nn][Tt]\s*\(\s*(-)?\d+(\.\d+)?\s+(-)?\d+(\.\d+)?\s*\)\s*'
 )
 
+# All datatypes detected by add_datatype combined into one alternation, such
+# that a literal only needs to be scanned once. The name of the matching group
+# tells the datatype: integer, decimal, date as DD.MM.YYYY or YYYY/MM/DD,
+# ISO datetime and point, tried in this order.
+DATATYPE_REGEX = re.compile(
+    r'(?P<int>-?\d+$)'
+    r'|(?P<float>-?\d+\.\d+$)'
+    r'|(?P<date_dmy>(?P<day>\d{2})\.(?P<month>\d{2})\.(?P<year>\d{4})$)'
+    r'|(?P<date_ymd>\d{4}/\d{2}/\d{2}$)'
+    r'|(?P<datetime>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z)'
+    r'|(?P<point>' + POINT_REGEX.pattern + ')'
+)
+
+# Points are the only datatype that may start with whitespace or "P"
+POINT_DATATYPE_REGEX = re.compile(r'(?P<point>' + POINT_REGEX.pattern + ')')
+
+# Bound methods used by add_datatype for every literal
+_match_datatype = DATATYPE_REGEX.match
+_match_point = POINT_DATATYPE_REGEX.match
+# Quotes and escapes a string exactly like json.dumps, but without its
+# argument handling and encoder construction
+_encode_str = encode_basestring_ascii
+
+
+def is_word(s: str) -> bool:
+    """
+    Checks if a string is non-empty and consists only of alphanumeric chars
+    and underscores. Same as fullmatch of the regex "\\w+", but cheaper.
+    """
+    return s.replace("_", "a").isalnum()
+
+
+def is_prefixed_name(s: str) -> bool:
+    """
+    Checks if a string is of the form "prefix:name" where the name may be
+    empty. Same as fullmatch of the regex "\\w+:\\w*", but cheaper.
+    """
+    prefix, sep, name = s.partition(":")
+    return bool(sep) and is_word(prefix) and (not name or is_word(name))
+
 
-@dataclass(frozen=True)
 class Prefix:
     """
     Class representing an RDF prefix declaration.
     """
 
-    # Note: this is an immutable / frozen object to avoid problems with set
-    # and/or manually defining __hash__.
+    # Note: this is an immutable object to avoid problems with set. The
+    # attributes are private and only exposed via getters. Prefixes are
+    # equal if both prefix and IRI are equal.
 
-    prefix: str
-    iri: str
+    __slots__ = ("__prefix", "__iri", "__declaration", "__hash")
 
-    def __post_init__(self):
+    def __init__(self, prefix: str, iri: str):
         # Use only alphanumeric chars for prefix
-        assert re.match(r'^\w+$', self.prefix), \
-            f"Prefixes must be alphanumeric, given '{self.prefix}'"
+        assert is_word(prefix), \
+            f"Prefixes must be alphanumeric, given '{prefix}'"
 
         # Use only valid http/https URLs as IRIs
-        parsed = urlparse(self.iri)
+        parsed = urlparse(iri)
         assert parsed.scheme in ("http", "https"), \
-            f"IRI should have http:// or https:// protocol, given '{self.iri}'"
+            f"IRI should have http:// or https:// protocol, given '{iri}'"
         assert parsed.netloc, \
             "IRI should be a valid URL with a hostname segment, " + \
-            f"given '{self.iri}'"
+            f"given '{iri}'"
         assert parsed.path.startswith("/"), \
             "IRI should be a valid URL with at least '/' " + \
-            f"as a path segment, given '{self.iri}'"
+            f"as a path segment, given '{iri}'"
+
+        self.__prefix = prefix
+        self.__iri = iri
+
+        # The object is immutable, so the declaration and hash can be
+        # computed once
+        self.__declaration = f"@prefix {prefix}: <{iri}> .\n"
+        self.__hash = hash((prefix, iri))
+
+    # Getters
+    @property
+    def prefix(self) -> str:
+        return self.__prefix
+
+    @property
+    def iri(self) -> str:
+        return self.__iri
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Prefix):
+            return NotImplemented
+        return self.__prefix == other.__prefix and self.__iri == other.__iri
+
+    def __hash__(self) -> int:
+        return self.__hash
+
+    def __repr__(self) -> str:
+        return f"Prefix(prefix={self.__prefix!r}, iri={self.__iri!r})"
 
     def __str__(self) -> str:
-        return f"@prefix {self.prefix}: <{self.iri}> .\n"
+        return self.__declaration
 
 
 # Predefined prefixes, this set can be updated by all modules using
@@ -110,9 +172,40 @@ DATE_LITERAL_TYPE = f"{XSD.prefix}:date"
 DATETIME_LITERAL_TYPE = f"{XSD.prefix}:dateTime"
 WKT_LITERAL_TYPE = f"{GEO.prefix}:wktLiteral"
 
+# Literal types for the groups of DATATYPE_REGEX and the groups that only
+# match digits and separators
+DATATYPE_LITERAL_TYPES = {
+    "int": INT_LITERAL_TYPE,
+    "float": FLOAT_LITERAL_TYPE,
+    "date_dmy": DATE_LITERAL_TYPE,
+    "date_ymd": DATE_LITERAL_TYPE,
+    "datetime": DATETIME_LITERAL_TYPE,
+    "point": WKT_LITERAL_TYPE
+}
+UNESCAPED_DATATYPES = frozenset(("int", "float", "date_dmy", "date_ymd"))
+
 # This counter is used to give unique numbers to entities who don't have
-# a unique identifier in the origin dataset
-GLOBAL_COUNTER = 0
+# a unique identifier in the origin dataset. Hot loops may bind
+# GLOBAL_COUNTER.__next__ locally instead of calling next_id().
+GLOBAL_COUNTER = count(1)
+
+# Cache for add_datatype: the number of entries after which the cache is
+# cleared and the maximum length of a literal to be cached
+DATATYPE_CACHE_SIZE = 1 << 16
+DATATYPE_CACHE_MAX_LEN = 64
+_datatype_cache: dict[str, str] = {}
+_datatype_cache_get = _datatype_cache.get
+
+# Buffer size in bytes for reading the stored input data in Dataset.content()
+CONTENT_BUFFER_SIZE = 1 << 20
+
+# Amount of uncompressed data in bytes which is compressed as one bzip2 stream
+# by ParallelBZ2Writer
+BZ2_CHUNK_SIZE = 1 << 23
+
+# Number of triples which are formatted before being written to the output
+# file at once by Dataset.to_file()
+TO_FILE_BATCH_SIZE = 65536
 
 # Using this dictionary global environment variables can be defined that
 # will be passed to all programs started for retrieving dataset content
@@ -125,26 +218,90 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def all_prefixes() -> Iterator[str]:
-    assert len(PREFIXES) == len(set(p.prefix for p in PREFIXES)), \
+@lru_cache(maxsize=16)
+def sorted_prefixes(prefixes: frozenset[Prefix]) -> tuple[str, ...]:
+    """
+    The sorted declarations of a set of prefixes. The result is cached, as
+    the set of prefixes usually does not change once all modules have added
+    their prefixes.
+    """
+    assert len(prefixes) == len(set(p.prefix for p in prefixes)), \
         "there may not be multiple IRIs for the same prefix"
 
     # set() may be unsorted in older Python versions
     # but we want deterministic output
-    for prefix in sorted(str(p) for p in PREFIXES):
-        yield prefix
+    return tuple(sorted(str(p) for p in prefixes))
+
+
+def all_prefixes() -> Iterator[str]:
+    yield from sorted_prefixes(frozenset(PREFIXES))
 
 
 def next_id() -> str:
-    global GLOBAL_COUNTER
-    GLOBAL_COUNTER += 1
-    return str(GLOBAL_COUNTER)
+    return str(next(GLOBAL_COUNTER))
 
 
 def set_get_data_env(key: str, value: str):
     GET_DATA_ENV[key] = value
 
 
+class ParallelBZ2Writer:
+    """
+    Binary file writer which compresses the written data with bzip2 using
+    multiple threads. The data is split into chunks of about `chunk_size`
+    bytes, which are compressed independently and written to the file as
+    consecutive bzip2 streams in their original order. Decompressors like
+    Python's bz2 module or the bzip2 program read such a file as one.
+    """
+
+    def __init__(self, filename: str, chunk_size: int = BZ2_CHUNK_SIZE,
+                 workers: Optional[int] = None):
+        workers = workers or os.cpu_count() or 1
+        self.__file = open(filename, "wb")
+        self.__chunk_size = chunk_size
+        self.__buffer = bytearray()
+        self.__executor = ThreadPoolExecutor(workers)
+        # Limits the memory used by compressed chunks waiting to be written
+        self.__max_pending = 2 * workers
+        self.__pending: deque[Future[bytes]] = deque()
+        self.__streams = 0
+
+    def __submit(self):
+        # bz2.compress releases the GIL, so the chunks are compressed in
+        # parallel
+        self.__pending.append(self.__executor.submit(
+            bz2.compress, bytes(self.__buffer)))
+        self.__buffer.clear()
+        self.__streams += 1
+        while len(self.__pending) > self.__max_pending:
+            self.__file.write(self.__pending.popleft().result())
+
+    def write(self, data: bytes):
+        self.__buffer += data
+        if len(self.__buffer) >= self.__chunk_size:
+            self.__submit()
+
+    def close(self):
+        """
+        Compresses the remaining data and closes the file.
+        """
+        if self.__file.closed:
+            return
+        if self.__buffer or not self.__streams:
+            # Even an empty file should be a valid bzip2 file
+            self.__submit()
+        while self.__pending:
+            self.__file.write(self.__pending.popleft().result())
+        self.__executor.shutdown()
+        self.__file.close()
+
+    def __enter__(self) -> 'ParallelBZ2Writer':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
 def triple(t: Triple) -> str:
     return " ".join(t) + " .\n"
 
@@ -154,50 +311,47 @@ def add_datatype(obj: str) -> str:
     Tries to guess the datatype by the content of the string.
     Will encode the string and, if detected, append datatype.
     """
-    def encode(obj_type: str = "") -> str:
-        if obj_type:
-            obj_type = '^^' + obj_type
-        return f"{json.dumps(str(obj).strip())}{obj_type}"
-
     if type(obj) is not str:
         return '""'
 
-    # Is it an int?
-    try:
-        if INT_REGEX.match(obj):
-            int(obj)  # Try conversion
-            return encode(INT_LITERAL_TYPE)
-    except ValueError:
-        pass
-
-    # Is it a float?
-    try:
-        if FLOAT_REGEX.match(obj):
-            float(obj)  # Try conversion
-            return encode(FLOAT_LITERAL_TYPE)
-    except ValueError:
-        pass
-
-    # Is it a date?
-    m = DATE_REGEX_DD_MM_YYYY.match(obj)
-    if m:
-        r = m.groupdict()
+    # Literals are highly repetitive (party names, districts, dates, counts),
+    # so results for short strings are cached
+    result = _datatype_cache_get(obj)
+    if result is None:
+        result = _add_datatype(obj)
+        if len(obj) <= DATATYPE_CACHE_MAX_LEN:
+            if len(_datatype_cache) >= DATATYPE_CACHE_SIZE:
+                _datatype_cache.clear()
+            _datatype_cache[obj] = result
+    return result
+
+
+def _add_datatype(obj: str) -> str:
+    # Numbers and dates start with a digit or a minus sign. Most literals
+    # start with neither, so their first char decides which regex to run.
+    first = obj[:1]
+    if first.isdecimal() or first == "-":
+        m = _match_datatype(obj)
+    elif first in "Pp" or first.isspace():
+        m = _match_point(obj)
+    else:
+        m = None
+    if not m:
+        # We don't know, so we keep it a string
+        return _encode_str(obj.strip())
+
+    kind = m.lastgroup
+    if kind == "date_dmy":
         # Needs rewriting to fit into rdf schema
-        obj = f"{r['year']}/{r['month']}/{r['day']}"
-        return encode(DATE_LITERAL_TYPE)
-
-    if DATE_REGEX_YYYY_MM_DD.match(obj):
-        return encode(DATE_LITERAL_TYPE)
+        value = f"{m['year']}/{m['month']}/{m['day']}"
+    else:
+        value = obj.strip()
 
-    if DATETIME_ISO_REGEX.match(obj):
-        return encode(DATETIME_LITERAL_TYPE)
-
-    # Is it a WKT point?
-    if POINT_REGEX.match(obj):
-        return encode(WKT_LITERAL_TYPE)
-
-    # We don't know, so we keep it a string
-    return encode()
+    # Numbers and dates only consist of digits and separators. Unless the
+    # digits are non-ASCII, they can be quoted without escaping.
+    if kind in UNESCAPED_DATATYPES and value.isascii():
+        return '"' + value + '"^^' + DATATYPE_LITERAL_TYPES[kind]
+    return _encode_str(value) + "^^" + DATATYPE_LITERAL_TYPES[kind]
 
 
 @dataclass
@@ -220,12 +374,11 @@ class Dataset(ABC):
     def __post_init__(self, _dataset: str, _command: Optional[str],
                       _store_filename: str, _primary_prefix: str):
         # Invariants
-        assert ":" in _primary_prefix \
-            and UNPROBLEMATIC_PREFIX.match(_primary_prefix), \
+        assert is_prefixed_name(_primary_prefix), \
             "primary_prefix should be alphanumeric and contain ':', but " + \
             f"'{_primary_prefix}' given"
         assert _store_filename
-        assert UNPROBLEMATIC_DATASET.match(_dataset), \
+        assert is_word(_dataset), \
             f"Please chose an alphanumeric dataset name for '{_dataset}'"
 
         # Attributes
@@ -264,15 +417,13 @@ class Dataset(ABC):
             return
         assert self.command, "No command provided but file not present"
         logger.info("%s: running %s", self.store_filename, self.command)
-        with subprocess.Popen(self.command,
-                              stdout=subprocess.PIPE,
-                              shell=True,
-                              env=GET_DATA_ENV,
-                              text=True) as proc, \
-                open(self.store_filename, "w") as f:
-            if proc.stdout:
-                for line in proc.stdout:
-                    print(line, file=f, end='')
+        # The command writes to the file directly without passing through
+        # this program
+        with open(self.store_filename, "wb") as f:
+            subprocess.run(self.command,
+                           stdout=f,
+                           shell=True,
+                           env=GET_DATA_ENV)
         self.__get_data_done = True
 
     def content(self) -> Iterator[str]:
@@ -282,9 +433,24 @@ class Dataset(ABC):
         assert self.__get_data_done, f"Dataset {self.dataset} not loaded"
         # Some text files may come with BOM which disturbs
         # for ex. csv.DictReader
-        with open(self.store_filename, "r", encoding="utf-8-sig") as f:
+        with open(self.store_filename, "r", encoding="utf-8-sig",
+                  buffering=CONTENT_BUFFER_SIZE) as f:
             yield from f
 
+    def content_bytes(self) -> Iterator[bytes]:
+        """
+        Like `content()`, but yields the raw data in large blocks of bytes
+        instead of decoded lines. A leading UTF-8 byte order mark is skipped.
+        """
+        assert self.__get_data_done, f"Dataset {self.dataset} not loaded"
+        with open(self.store_filename, "rb") as f:
+            block = f.read(CONTENT_BUFFER_SIZE)
+            if block.startswith(codecs.BOM_UTF8):
+                block = block[len(codecs.BOM_UTF8):]
+            while block:
+                yield block
+                block = f.read(CONTENT_BUFFER_SIZE)
+
     @property
     def clean_prefix(self) -> str:
         return self.primary_prefix.split(":")[0] + ":"
@@ -311,11 +477,17 @@ class Dataset(ABC):
             logger.warning(
                 "Output filename is expected to end with '.ttl.bz2'")
         self.get_data()
-        with bz2.open(filename, "wb") as zf:
-            f = TextIOWrapper(zf)
-            f.writelines(all_prefixes())
+        # Each batch is encoded at once and written to the compressor
+        # directly, without a text layer in between
+        with ParallelBZ2Writer(filename) as f:
+            f.write("".join(all_prefixes()).encode("utf-8"))
+            batch: list[str] = []
             for t in self.rdf():
-                f.write(triple(t))
-                counter += 1
-            f.close()
+                batch.append(triple(t))
+                if len(batch) == TO_FILE_BATCH_SIZE:
+                    f.write("".join(batch).encode("utf-8"))
+                    counter += len(batch)
+                    batch.clear()
+            f.write("".join(batch).encode("utf-8"))
+            counter += len(batch)
         return counter
@@ -25,10 +25,11 @@ from dataclasses import dataclass, field, InitVar
 from typing import Iterator, Optional, Sequence
 from datetime import datetime
 from contextlib import nullcontext
-import bz2
+import codecs
 from io import TextIOWrapper
 from dataset import LABEL, TYPE, PREFIXES, Dataset, Prefix, all_prefixes, \
-    next_id, Triple, add_datatype, set_get_data_env
+    next_id, Triple, add_datatype, set_get_data_env, triple, \
+    TO_FILE_BATCH_SIZE, CONTENT_BUFFER_SIZE, ParallelBZ2Writer
 from csv2rdf import CSVDataset, set_warn_missing_col_mapping
 from kml2rdf import KMLDataset, AuxGeoCallback
 
@@ -46,6 +47,14 @@ WD = Prefix("wd", "http://www.wikidata.org/entity/")
 OSMREL = Prefix("osmrel", "https://www.openstreetmap.org/relation/")
 PREFIXES.update({WD, OSMREL})
 
+# Type and predicates of the election metadata
+ELECTION_TYPE = f"{ELECTION}:election"
+ELECTION_WIKIDATA = f"{ELECTION}:wikidata"
+ELECTION_OSM = f"{ELECTION}:osm"
+ELECTION_COUNTRYNAME = f"{ELECTION}:countryname"
+ELECTION_DATE = f"{ELECTION}:date"
+ELECTION_YEAR = f"{ELECTION}:year"
+
 logger = logging.getLogger(__name__)
 
 
@@ -175,22 +184,22 @@ class Election:
         """
         # Global triples on the election
         logger.info("Emitting general info")
-        yield (self.__id, TYPE, f"{ELECTION}:election")
+        yield (self.__id, TYPE, ELECTION_TYPE)
         yield (self.__id, LABEL, add_datatype(self.label))
         if self.wikidata:
-            yield (self.__id, f"{ELECTION}:wikidata",
+            yield (self.__id, ELECTION_WIKIDATA,
                    f"{WD.prefix}:{self.wikidata}")
         if self.osm:
-            yield (self.__id, f"{ELECTION}:osm",
+            yield (self.__id, ELECTION_OSM,
                    f"{OSMREL.prefix}:{self.osm}")
         if self.countryname:
-            yield (self.__id, f"{ELECTION}:countryname",
+            yield (self.__id, ELECTION_COUNTRYNAME,
                    add_datatype(self.countryname))
         if self.date:
-            yield (self.__id, f"{ELECTION}:date",
+            yield (self.__id, ELECTION_DATE,
                    add_datatype(self.date))
         if self.year:
-            yield (self.__id, f"{ELECTION}:year",
+            yield (self.__id, ELECTION_YEAR,
                    add_datatype(str(self.year)))
 
         # Main election results
@@ -198,9 +207,8 @@ class Election:
         for d in self.datasets:
             logger.info(f"Emitting {d.dataset}")
             d.parent = self.__id
-            match d:
-                case KMLDataset():
-                    d.aux_geo_callback = self.aux_geo_callback
+            if isinstance(d, KMLDataset):
+                d.aux_geo_callback = self.aux_geo_callback
             yield from d.rdf()
 
     def to_file(self, output: TextIOWrapper,
@@ -211,7 +219,7 @@ class Election:
         """
         if aux_geo is not None:
             def ag_cb(_id: str, _wkt: str):
-                print(_id + "\t" + _wkt, file=aux_geo)
+                aux_geo.write(_id + "\t" + _wkt + "\n")
             self.aux_geo_callback = ag_cb
 
         output.writelines(all_prefixes())
@@ -220,9 +228,16 @@ class Election:
 
         start = datetime.now()
         count = 0
-        for s in self.rdf():
-            count += 1
-            print(" ".join(s) + " .", file=output)
+        # Serialized triples are collected and written in batches
+        batch: list[str] = []
+        for t in self.rdf():
+            batch.append(triple(t))
+            if len(batch) == TO_FILE_BATCH_SIZE:
+                output.write("".join(batch))
+                count += len(batch)
+                batch.clear()
+        output.write("".join(batch))
+        count += len(batch)
         logger.info("Took %s", str(datetime.now() - start))
 
         logger.info("Emitted %i triples", count)
@@ -343,11 +358,16 @@ def main(argv: Optional[Sequence[str]] = None):
     election.get_all_data()
     logger.info("Took %s", str(datetime.now() - start))
 
-    aux_geo_file = open(aux_geo, "w") if aux_geo is not None else nullcontext()
+    aux_geo_file = open(aux_geo, "w", encoding="utf-8",
+                        buffering=CONTENT_BUFFER_SIZE) \
+        if aux_geo is not None else nullcontext()
     if not output.endswith(".ttl.bz2"):
         logger.warning("Output filename does not end in '.ttl.bz2'")
-    with bz2.open(output, "wb") as f, aux_geo_file as agf:
-        election.to_file(TextIOWrapper(f), agf)
+    # Election.to_file writes large batches of triples, which are encoded
+    # and passed to the compressor at once. The compression runs in worker
+    # threads while the next triples are generated.
+    with ParallelBZ2Writer(output) as f, aux_geo_file as agf:
+        election.to_file(codecs.getwriter("utf-8")(f), agf)
 
 
 if __name__ == "__main__":
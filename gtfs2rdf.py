@@ -19,15 +19,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import re
+import csv
 import argparse
 import logging
-import bz2
-from io import TextIOWrapper
+import codecs
+from array import array
+from io import BufferedReader, TextIOWrapper
 from typing import Iterator, NotRequired, Optional, TypedDict, Sequence
 from dataclasses import dataclass, field, InitVar
 from dataset import DATE_LITERAL_TYPE, TYPE, all_prefixes, Prefix, PREFIXES, \
     Triple, triple, HAS_GEOMETRY, AS_WKT, HAS_CENTROID, \
-    WKT_LITERAL_TYPE
+    WKT_LITERAL_TYPE, is_word, ParallelBZ2Writer, TO_FILE_BATCH_SIZE, \
+    CONTENT_BUFFER_SIZE
 from csv2rdf import CSVColumnMapping, CSVDataset, CSVValuesMapping, \
     CSVValuesMappingRules, ExtraTripleCallback
 from kml2rdf import AuxGeoCallback
@@ -68,8 +71,140 @@ GtfsFileCsvConfig = TypedDict("GtfsFileCsvConfig", {
     "extra_triple_callback": NotRequired[ExtraTripleCallback]
 })
 GtfsCsvConfig = dict[str, GtfsFileCsvConfig]
-# Shape cache: Subject => List of (Sequence Number, Longitude, Latitude)
-GtfsShapeCache = dict[str, list[tuple[int, str, str]]]
+# Shape cache: Subject => (Sequence Numbers, Points as "Longitude Latitude").
+# Storing the columns separately keeps the memory per shape point low.
+GtfsShapeCache = dict[str, tuple[array, list[str]]]
+
+# Closing quote and datatype of date literals
+DATE_SUFFIX = f'"^^{DATE_LITERAL_TYPE}'
+
+# Progress is logged whenever the number of triples emitted has all bits of
+# this mask unset, i.e. every 2^20 triples
+PROGRESS_LOG_MASK = (1 << 20) - 1
+
+# Non-word chars in identifiers are replaced by their code point in hex
+NALPH_REGEX = re.compile("\\W")
+
+
+class NalphTable(dict[int, str]):
+    """
+    Translation table for `str.translate` which maps non-word chars to their
+    hexadecimal code point and word chars to themselves. Entries are created
+    on first use, so every char is only checked once.
+    """
+
+    def __missing__(self, c: int) -> str:
+        char = chr(c)
+        value = format(c, '#08x') if NALPH_REGEX.match(char) else char
+        self[c] = value
+        return value
+
+
+NALPH_TABLE = NalphTable()
+
+# Matches an entire cell value, used for replace rules which rewrite the
+# whole value at once
+WHOLE_VALUE_REGEX = re.compile("(?s)\\A.*\\Z")
+
+
+def shape_points(seqs: array, points: list[str]) -> str:
+    """
+    Joins the points of a shape to a comma-separated well-known text point
+    list, ordered by their sequence numbers.
+    """
+    # The points of a shape are usually listed in order already
+    if all(a < b for a, b in zip(seqs, seqs[1:])):
+        return ", ".join(points)
+    return ", ".join(p for _, p in sorted(zip(seqs, points)))
+
+
+def gtfs_date(s: str) -> str:
+    """
+    Converts a GTFS date (YYYYMMDD) to an RDF date literal.
+    """
+    if len(s) != 8:
+        return f'"{s}"'
+    return f'"{s[:4]}/{s[4:6]}/{s[6:]}{DATE_SUFFIX}'
+
+
+def replace_nalph(s: str) -> str:
+    """
+    Replaces all non-word chars in a string by their hexadecimal code point.
+    """
+    return s.translate(NALPH_TABLE)
+
+
+# Values mappings and callbacks which do not depend on the feed
+INT_TO_BOOL: tuple[CSVValuesMappingRules, bool] = ([
+    ("^0$", "\"false\"^^xsd:boolean"),
+    ("^1$", "\"true\"^^xsd:boolean")
+], False)
+
+DATE_ADDITION_TO_BOOL: tuple[CSVValuesMappingRules, bool] = ([
+    ("^2$", "\"false\"^^xsd:boolean"),
+    ("^1$", "\"true\"^^xsd:boolean")
+], False)
+
+PICKUP_DROP_OFF: tuple[CSVValuesMappingRules, bool] = ([
+    ("^$", "gtfs:Regular"),
+    ("^0$", "gtfs:Regular"),
+    ("^1$", "gtfs:NotAvailable"),
+    ("^2$", "gtfs:MustPhone"),
+    ("^3$", "gtfs:MustCoordinateWithDriver"),
+], False)
+
+
+def temporal(subj: str, start: str, end: str) -> Iterator[Triple]:
+    yield (subj, "dct:temporal", subj + "_temporal")
+    yield (subj + "_temporal", "schema:startDate", gtfs_date(start))
+    yield (subj + "_temporal", "schema:endDate", gtfs_date(end))
+
+
+def calendar_etc(_: CSVDataset, subj: str, row: dict[str, str]) \
+        -> Iterator[Triple]:
+    yield from temporal(subj, row["start_date"], row["end_date"])
+
+
+def feed_info_etc(_: CSVDataset, subj: str, row: dict[str, str]) \
+        -> Iterator[Triple]:
+    yield (subj, TYPE, "dcat:Dataset")
+    yield from temporal(subj, row["feed_start_date"], row["feed_end_date"])
+
+
+@dataclass
+class GTFSTableDataset(CSVDataset):
+    """
+    A table of a GTFS feed. It is read from the feed's zip file directly
+    instead of being extracted to disk first.
+
+    Fields in addition to `CSVDataset`:
+
+    - `zip_filename`:   The GTFS zip file. The `_store_filename` is the name
+                        of the table's member file in the zip.
+    - `zip_file`:       An open `ZipFile` of `zip_filename` to be used
+                        instead of opening the file again. (optional)
+    """
+
+    zip_filename: str = ""
+    zip_file: Optional[ZipFile] = field(default=None, compare=False,
+                                        repr=False)
+
+    def get_data(self):
+        """
+        Nothing to be done, the data is read from the zip file on demand.
+        """
+
+    def content(self) -> Iterator[str]:
+        """
+        Yields the data of the table line by line while decompressing it.
+        """
+        zip_file = nullcontext(self.zip_file) if self.zip_file is not None \
+            else ZipFile(self.zip_filename, "r")
+        with zip_file as zf, \
+                zf.open(self.store_filename, "r") as member, \
+                TextIOWrapper(BufferedReader(member, CONTENT_BUFFER_SIZE),
+                              encoding="utf-8-sig") as f:
+            yield from f
 
 
 @dataclass
@@ -91,8 +226,9 @@ class GTFSFeed:
                             should be emitted also as well-known text line
                             string geometries in addition to the standardized
                             shape points; requires memory for remembering
-                            shapes during computation; does nothing if
-                            shapes.txt is excluded.
+                            shapes during computation, unless the points of
+                            each shape are listed consecutively; does nothing
+                            if shapes.txt is excluded.
     - `aux_geo_callback`:   A callback to emit well-known text geometries for
                             an osm2rdf aux-geo file, see kml2rdf (optional)
 
@@ -108,16 +244,18 @@ class GTFSFeed:
     aux_geo_callback: AuxGeoCallback = None
 
     # Internal configuration attributes
-    __datasets: list[CSVDataset] = field(default_factory=list, init=False)
+    __datasets: list[GTFSTableDataset] = field(default_factory=list,
+                                               init=False)
     __config: GtfsCsvConfig = field(default_factory=dict, init=False)
     __members: list[str] = field(default_factory=list, init=False)
     __shapes: GtfsShapeCache = field(
         default_factory=dict, init=False)
+    __stream_shapes: bool = field(default=False, init=False)
 
     def __post_init__(self, _feed: str, _filename: str, _excludes: list[str],
                       _add_linestrings: bool):
         # Invariant
-        assert re.match(r"^\w+$", _feed), "Feed name must be alphanum."
+        assert is_word(_feed), "Feed name must be alphanum."
         # Properties
         self.__feed = _feed
         self.__filename = _filename
@@ -153,47 +291,17 @@ class GTFSFeed:
         if self.__config != {}:
             return
 
-        int2bool = ([("^0$", "\"false\"^^xsd:boolean"), (
-                    "^1$", "\"true\"^^xsd:boolean")], False)
-
-        dateAddition2bool = ([("^2$", "\"false\"^^xsd:boolean"), (
-            "^1$", "\"true\"^^xsd:boolean")], False)
+        # IRI prefixes used by the callbacks for every row
+        shape_prefix = f"gtfs:shape_{self.feed}_"
+        station_prefix = f"gtfs:station_{self.feed}_"
 
-        replace_nalph = ("(?P<m>\\W)", lambda m: format(
-            ord(m.group("m")), '#08x'))
+        # Replace rules which rewrite the whole value in one step
+        identifier = [(WHOLE_VALUE_REGEX, lambda m: replace_nalph(m[0]))]
 
         def foreign(table: str) -> CSVValuesMappingRules:
-            return [replace_nalph,
-                    ("^(?P<content>.*)$",
-                     f"gtfs:{table}_{self.feed}_\\g<content>")]
-
-        pickUp_dropOff = ([
-            ("^$", "gtfs:Regular"),
-            ("^0$", "gtfs:Regular"),
-            ("^1$", "gtfs:NotAvailable"),
-            ("^2$", "gtfs:MustPhone"),
-            ("^3$", "gtfs:MustCoordinateWithDriver"),
-        ], False)
-
-        def date(s: str) -> str:
-            if len(s) != 8:
-                return f'"{s}"'
-            return f'"{s[0:4]}/{s[4:6]}/{s[6:8]}"^^{DATE_LITERAL_TYPE}'
-
-        def temporal(subj: str, start: str, end: str) -> Iterator[Triple]:
-            yield (subj, "dct:temporal", subj + "_temporal")
-            yield (subj + "_temporal", "schema:startDate", date(start))
-            yield (subj + "_temporal", "schema:endDate", date(end))
-
-        def calendar_etc(_: CSVDataset, subj: str, row: dict[str, str]) \
-                -> Iterator[Triple]:
-            yield from temporal(subj, row["start_date"], row["end_date"])
-
-        def feed_info_etc(_: CSVDataset, subj: str, row: dict[str, str]) \
-                -> Iterator[Triple]:
-            yield (subj, TYPE, "dcat:Dataset")
-            yield from temporal(subj, row["feed_start_date"],
-                                row["feed_end_date"])
+            prefix = f"gtfs:{table}_{self.feed}_"
+            return [(WHOLE_VALUE_REGEX,
+                     lambda m: prefix + replace_nalph(m[0]))]
 
         def point(subj: str, lon: str, lat: str) -> Iterator[Triple]:
             yield (subj, HAS_GEOMETRY, subj + "_geo")
@@ -205,27 +313,28 @@ class GTFSFeed:
 
         def shapes_etc(_: CSVDataset, subj: str, row: dict[str, str]) \
                 -> Iterator[Triple]:
-            shape_subj = "gtfs:shape_" + self.feed + "_" + \
-                re.sub(*replace_nalph, row["shape_id"])
+            shape_subj = shape_prefix + replace_nalph(row["shape_id"])
             yield (shape_subj, TYPE, "gtfs:Shape")
             yield (shape_subj, "gtfs:shapePoint", subj)
             yield from point(subj, row['shape_pt_lon'], row['shape_pt_lat'])
             if self.add_linestrings:
-                if shape_subj not in self.__shapes:
-                    self.__shapes[shape_subj] = []
-                shape_point = (
-                    int(row['shape_pt_sequence']),
-                    row['shape_pt_lon'],
-                    row['shape_pt_lat']
-                )
-                self.__shapes[shape_subj].append(shape_point)
+                shape = self.__shapes.get(shape_subj)
+                if shape is None:
+                    if self.__stream_shapes and self.__shapes:
+                        # A new shape starts, so the previous one is
+                        # complete
+                        prev_subj, (seqs, points) = self.__shapes.popitem()
+                        yield from self.__linestring(prev_subj, seqs, points)
+                    shape = self.__shapes[shape_subj] = (array("q"), [])
+                shape[0].append(int(row['shape_pt_sequence']))
+                shape[1].append(row['shape_pt_lon'] + " " +
+                                row['shape_pt_lat'])
 
         def stops_etc(_: CSVDataset, subj: str, row: dict[str, str]) \
                 -> Iterator[Triple]:
             yield from point(subj, row['stop_lon'], row['stop_lat'])
             if "parent_station" in row and row["parent_station"]:
-                yield (f"gtfs:station_{self.feed}_" +
-                       re.sub(*replace_nalph, row['parent_station']),
+                yield (station_prefix + replace_nalph(row['parent_station']),
                        TYPE, "gtfs:Station")
 
         self.__config = {
@@ -242,7 +351,7 @@ class GTFSFeed:
                     "agency_phone": "foaf:phone"
                 },
                 "values_mapping": {
-                    "dct:identifier": ([replace_nalph], True)
+                    "dct:identifier": (identifier, True)
                 }
             },
             "calendar.txt": {
@@ -264,13 +373,13 @@ class GTFSFeed:
                 },
                 "values_mapping": {
                     "gtfs:service": (foreign("service"), False),
-                    "gtfs:monday": int2bool,
-                    "gtfs:tuesday": int2bool,
-                    "gtfs:wednesday": int2bool,
-                    "gtfs:thursday": int2bool,
-                    "gtfs:friday": int2bool,
-                    "gtfs:saturday": int2bool,
-                    "gtfs:sunday": int2bool,
+                    "gtfs:monday": INT_TO_BOOL,
+                    "gtfs:tuesday": INT_TO_BOOL,
+                    "gtfs:wednesday": INT_TO_BOOL,
+                    "gtfs:thursday": INT_TO_BOOL,
+                    "gtfs:friday": INT_TO_BOOL,
+                    "gtfs:saturday": INT_TO_BOOL,
+                    "gtfs:sunday": INT_TO_BOOL,
                 },
                 # Provides dct:temporal
                 "extra_triple_callback": calendar_etc
@@ -286,7 +395,7 @@ class GTFSFeed:
                 },
                 "values_mapping": {
                     "gtfs:service": (foreign("service"), False),
-                    "gtfs:dateAddition": dateAddition2bool
+                    "gtfs:dateAddition": DATE_ADDITION_TO_BOOL
                 }
             },
             "feed_info.txt": {
@@ -356,12 +465,8 @@ class GTFSFeed:
                     "route_desc": "dct:description"
                 },
                 "values_mapping": {
-                    "dct:identifier": ([replace_nalph], True),
-                    "gtfs:agency": ([
-                        replace_nalph,
-                        ("^(?P<content>.*)$",
-                            f"gtfs:agency_{self.feed}_\\g<content>")
-                    ], False),
+                    "dct:identifier": (identifier, True),
+                    "gtfs:agency": (foreign("agency"), False),
                     "gtfs:routeType": ([
                         ("^0$", "gtfs:LightRail"),
                         ("^1$", "gtfs:Subway"),
@@ -411,7 +516,7 @@ class GTFSFeed:
                     # "level_id": ""
                 },
                 "values_mapping": {
-                    "dct:identifier": ([replace_nalph], True),
+                    "dct:identifier": (identifier, True),
                     "gtfs:parentStation": (foreign("station"), False)
                 },
                 "extra_triple_callback": stops_etc
@@ -433,8 +538,8 @@ class GTFSFeed:
                 "values_mapping": {
                     "gtfs:trip": (foreign("trip"), False),
                     "gtfs:stop": (foreign("stop"), False),
-                    "gtfs:pickupType": pickUp_dropOff,
-                    "gtfs:dropOffType": pickUp_dropOff,
+                    "gtfs:pickupType": PICKUP_DROP_OFF,
+                    "gtfs:dropOffType": PICKUP_DROP_OFF,
                 }
             },
             "transfers.txt": {
@@ -487,13 +592,13 @@ class GTFSFeed:
                     "bikes_allowed": "gtfs:bikesAllowed"
                 },
                 "values_mapping": {
-                    "dct:identifier": ([replace_nalph], True),
+                    "dct:identifier": (identifier, True),
                     "gtfs:service": (foreign("service"), False),
                     "gtfs:route": (foreign("route"), False),
                     "gtfs:shape": (foreign("shape"), False),
-                    "gtfs:direction": int2bool,
-                    "gtfs:wheelchairAccessible": int2bool,
-                    "gtfs:bikesAllowed": int2bool
+                    "gtfs:direction": INT_TO_BOOL,
+                    "gtfs:wheelchairAccessible": INT_TO_BOOL,
+                    "gtfs:bikesAllowed": INT_TO_BOOL
                 }
             }
         }
@@ -539,7 +644,7 @@ class GTFSFeed:
                     table)
                 continue
 
-            d = CSVDataset(
+            d = GTFSTableDataset(
                 _dataset=config["dataset"],
                 _command=None,  # f"unzip -qq -c $GTFS_FILE {table}"
                 _store_filename=table,
@@ -550,67 +655,118 @@ class GTFSFeed:
                 column_mapping=config["column_mapping"],
                 primary_col=config["primary_col"],
                 values_mapping=config["values_mapping"],
-                extra_triple_callback=config.get("extra_triple_callback", None)
+                extra_triple_callback=config.get("extra_triple_callback",
+                                                 None),
+                zip_filename=self.filename
             )
             self.__datasets.append(d)
 
         assert self.__datasets != [], "No supported files found in input zip"
 
+    def __shapes_contiguous(self) -> bool:
+        """
+        Checks whether the points of each shape are listed consecutively in
+        shapes.txt. Then the line string of a shape can be emitted as soon
+        as the next shape starts, instead of caching all shapes until the
+        end.
+
+        This needs a separate pass over shapes.txt: whether a shape is
+        complete when the next one starts is only known at the end of the
+        file, and an emitted line string cannot be taken back if more of
+        its points follow later. The pass only parses the CSV, which is
+        cheap compared to emitting and compressing the triples.
+        """
+        d = next((d for d in self.__datasets
+                  if d.store_filename == "shapes.txt"), None)
+        if d is None:
+            return False
+        reader = csv.reader(d.content(), delimiter=d.csv_separator,
+                            quotechar=d.csv_quote)
+        header = next(reader, [])
+        if "shape_id" not in header:
+            return False
+        col = header.index("shape_id")
+        seen: set[str] = set()
+        current = None
+        for row in reader:
+            if len(row) <= col or row[col] == current:
+                continue
+            current = row[col]
+            # Compare as in the subjects, which hex-encode some chars
+            shape = replace_nalph(current)
+            if shape in seen:
+                return False
+            seen.add(shape)
+        return True
+
+    def __linestring(self, subj: str, seqs: array, points: list[str]) \
+            -> Iterator[Triple]:
+        """
+        Emits the well-known text line string geometry of a shape.
+        """
+        points_str = shape_points(seqs, points)
+        yield (subj, HAS_GEOMETRY, subj + "_geo")
+        yield (subj + "_geo", AS_WKT,
+               f"\"LINESTRING({points_str})\"^^{WKT_LITERAL_TYPE}")
+        if self.aux_geo_callback:
+            self.aux_geo_callback(subj, f"LINESTRING({points_str})")
+
     # Public user functions
     def get_all_data(self):
         """
-        Extracts all supported, not-excluded files from the given input zip
-        into the current working directory.
+        Prepares all supported, not-excluded files from the given input zip.
+        They are read from the zip directly, without extracting them.
         """
         assert self.__datasets != [], \
             "Did not call __make_datasets() before calling get_all_data()"
-        logger.info("Extracting data from %s...", self.filename)
-        with ZipFile(self.filename, "r") as zf:
-            for d in self.__datasets:
-                logger.info("Extracting %s", d.store_filename)
-                zf.extract(d.store_filename)
-                # set_get_data_env("GTFS_FILE", self.filename)
-                d.get_data()
+        logger.info("Reading data from %s...", self.filename)
+        for d in self.__datasets:
+            d.get_data()
 
     def rdf(self) -> Iterator[Triple]:
         assert self.__datasets != [], \
             "Please call get_all_data() first"
 
+        # All tables are read using the same handle of the zip file
+        with ZipFile(self.filename, "r") as zf:
+            for d in self.__datasets:
+                d.zip_file = zf
+            try:
+                yield from self.__rdf()
+            finally:
+                for d in self.__datasets:
+                    d.zip_file = None
+
+    def __rdf(self) -> Iterator[Triple]:
         count = 0
-        dataset = ""
-
-        def _count():
-            nonlocal count
-            count += 1
-            if count % 100000 == 0:
-                logger.info(
-                    "%d triples emitted in total, " +
-                    "currently processing %s", count, dataset)
 
         # Reset shapes cache for multiple runs of rdf()
         self.__shapes = {}
+        self.__stream_shapes = False
+        if self.add_linestrings and "shapes.txt" not in self.excludes:
+            self.__stream_shapes = self.__shapes_contiguous()
+            if not self.__stream_shapes:
+                logger.info("Shapes are not listed consecutively, " +
+                            "caching all shapes for line strings")
 
         for d in self.__datasets:
             logger.info("Emitting triples for %s", d.dataset)
-            dataset = d.dataset
-            for t in d.rdf():
-                _count()
+            for count, t in enumerate(d.rdf(), count + 1):
+                if not count & PROGRESS_LOG_MASK:
+                    logger.info(
+                        "%d triples emitted in total, " +
+                        "currently processing %s", count, d.dataset)
                 yield t
+            logger.info("%d triples emitted in total", count)
 
         if self.add_linestrings and "shapes.txt" not in self.excludes:
             logger.info("Emitting geometry triples for shapes")
-            dataset = "Shapes to LineStrings"
-            for subj, points in self.__shapes.items():
-                _count()
-                yield (subj, HAS_GEOMETRY, subj + "_geo")
-                _count()
-                points_str = ", ".join(
-                    p[1] + " " + p[2] for p in sorted(points)
-                )
-                yield (subj + "_geo", AS_WKT,
-                       f"\"LINESTRING({points_str})\"^^{WKT_LITERAL_TYPE}")
-                if self.aux_geo_callback:
-                    self.aux_geo_callback(subj, f"LINESTRING({points_str})")
+            # When streaming, only the last shape is left here
+            for subj, (seqs, points) in self.__shapes.items():
+                for count, t in enumerate(
+                        self.__linestring(subj, seqs, points), count + 1):
+                    yield t
+            logger.info("%d triples emitted in total", count)
         elif self.add_linestrings:
             logger.warning(
                 "'add_linestrings' is true but 'shapes.txt' is excluded.")
@@ -626,8 +782,14 @@ class GTFSFeed:
             logger.info("Emitting prefixes")
             output.writelines(all_prefixes())
         logger.info("Emitting data:")
+        # Serialized triples are collected and written in batches
+        batch: list[str] = []
         for t in self.rdf():
-            output.write(triple(t))
+            batch.append(triple(t))
+            if len(batch) == TO_FILE_BATCH_SIZE:
+                output.write("".join(batch))
+                batch.clear()
+        output.write("".join(batch))
         output.close()
 
 
@@ -663,7 +825,8 @@ def parse_arguments(argv: Optional[Sequence[str]]) -> argparse.Namespace:
     parser.add_argument(
         '--add-linestrings', '-l', action='store_true',
         help='translate GTFS shapes.txt to WKT LINESTRING geometries ' +
-        '(requires that shapes.txt fits into memory)')
+        '(requires that shapes.txt fits into memory, unless the points of ' +
+        'each shape are listed consecutively)')
     parser.add_argument(
         '--skip-prefixes', '-n', action='store_true',
         help='do not output @prefix declarations')
@@ -688,13 +851,16 @@ def main(argv: Optional[Sequence[str]] = None):
 
     if not _output.endswith(".ttl.bz2"):
         logger.warning("Output filename does not end in '.ttl.bz2'")
-    _agf = open(_aux_geo, "w") if _aux_geo is not None else nullcontext()
-    with bz2.open(_output, "wb") as f, _agf as agf:
+    _agf = open(_aux_geo, "w", encoding="utf-8",
+                buffering=CONTENT_BUFFER_SIZE) \
+        if _aux_geo is not None else nullcontext()
+    # The output is compressed in worker threads while triples are generated
+    with ParallelBZ2Writer(_output) as f, _agf as agf:
         def agc(subj: str, wkt: str):
             if _aux_geo is not None:
-                print(subj + "\t" + wkt, file=agf)
+                agf.write(subj + "\t" + wkt + "\n")
         gtfs.aux_geo_callback = agc
-        gtfs.to_file(TextIOWrapper(f), not args.skip_prefixes)
+        gtfs.to_file(codecs.getwriter("utf-8")(f), not args.skip_prefixes)
 
 
 if __name__ == "__main__":
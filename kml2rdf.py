@@ -21,15 +21,17 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from zipfile import ZipFile
 from dataset import PREFIXES, Prefix, WKT_LITERAL_TYPE, \
     Dataset, Triple, next_id, TYPE, MEMBER, LABEL, COMMENT, IDENTIFIER, \
-    HAS_GEOMETRY, AS_WKT, add_datatype
+    HAS_GEOMETRY, AS_WKT, CONTENT_BUFFER_SIZE, add_datatype
 from contextlib import nullcontext
+from shutil import copyfileobj
 import logging
 import argparse
 import xml.etree.ElementTree as ET
 from dataclasses import dataclass, field
+from functools import cached_property
 from typing import Callable, Iterator, Optional, Any, Sequence
 from abc import ABC, abstractmethod
-from io import StringIO
+from io import BytesIO, StringIO
 
 PROGRAM_DESCRIPTION = """
     kml2rdf - create RDF turtle from a KML or KMZ file.
@@ -54,20 +56,35 @@ logger = logging.getLogger(__name__)
 class KMLXPathHelper:
     """
     This helper class provides XPath queries for extracting geometries from KML
+
+    The queries and qualified tag names are built once per helper. The hot
+    paths compare the tags of child elements directly instead of evaluating
+    the equivalent XPath.
     """
     schema: str = "http://www.opengis.net/kml/2.2"
     schema_gx: str = "http://www.google.com/kml/ext/2.2"
 
     @staticmethod
-    def from_kml_source(source: str) -> 'KMLXPathHelper':
+    def from_kml_source(source: str | bytes) -> 'KMLXPathHelper':
         """
-        Create the XPath helper from a KML source string (detect namespace)
+        Create the XPath helper from a KML source string or the raw bytes of
+        a KML file (detect namespace)
         """
 
         # Extract namespaces from KML source
         # Source: https://stackoverflow.com/a/42372404
-        iterp = ET.iterparse(StringIO(source), events=['start-ns'])
-        namespaces = dict(node for _, node in iterp)
+        iterp = ET.iterparse(
+            BytesIO(source) if isinstance(source, bytes)
+            else StringIO(source), events=['start-ns'])
+        return KMLXPathHelper.from_namespaces(
+            dict(node for _, node in iterp))
+
+    @staticmethod
+    def from_namespaces(namespaces: dict[str, str]) -> 'KMLXPathHelper':
+        """
+        Create the XPath helper from the namespaces declared in a KML file
+        (mapping from namespace prefix to URI)
+        """
 
         # We require the main namespace from <kml xmlns=...>
         assert '' in namespaces
@@ -83,67 +100,99 @@ class KMLXPathHelper:
         else:
             return KMLXPathHelper(main)
 
-    @property
+    @cached_property
     def KML_SCHEMA(self) -> str:
         return f"{{{self.schema}}}"
 
-    @property
+    @cached_property
     def KML_GX_SCHEMA(self) -> str:
         return f"{{{self.schema_gx}}}"
 
     # The following XPaths are based on the helpful KML code examples from
     # https://developers.google.com/kml/documentation/kml_tut
 
-    @property
+    @cached_property
     def KML_PLACEMARK_XPATH(self) -> str:
         return f".//{self.KML_SCHEMA}Placemark"
 
-    @property
+    @cached_property
     def KML_NAME_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}name"
 
-    @property
+    @cached_property
     def KML_DESCRIPTION_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}description"
 
-    @property
+    @cached_property
     def KML_MULTI_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}MultiGeometry"
 
-    @property
+    @cached_property
     def KML_POLYGON_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}Polygon"
 
-    @property
+    @cached_property
     def KML_POLYGON_OUTER_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}outerBoundaryIs/" + \
             f"{self.KML_SCHEMA}LinearRing/{self.KML_SCHEMA}coordinates"
 
-    @property
+    @cached_property
     def KML_POLYGON_INNER_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}innerBoundaryIs/" + \
             f"{self.KML_SCHEMA}LinearRing/{self.KML_SCHEMA}coordinates"
 
-    @property
+    @cached_property
     def KML_POINT_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}Point/{self.KML_SCHEMA}coordinates"
 
-    @property
+    @cached_property
     def KML_LINE_XPATH(self) -> str:
         return f"./{self.KML_SCHEMA}LineString/{self.KML_SCHEMA}coordinates"
 
+    @cached_property
+    def KML_PLACEMARK_TAG(self) -> str:
+        return f"{self.KML_SCHEMA}Placemark"
+
+    @cached_property
+    def KML_MULTI_TAG(self) -> str:
+        return f"{self.KML_SCHEMA}MultiGeometry"
+
+    @cached_property
+    def KML_POLYGON_TAG(self) -> str:
+        return f"{self.KML_SCHEMA}Polygon"
+
+    @cached_property
+    def KML_POINT_TAG(self) -> str:
+        return f"{self.KML_SCHEMA}Point"
+
+    @cached_property
+    def KML_LINE_TAG(self) -> str:
+        return f"{self.KML_SCHEMA}LineString"
+
+    @cached_property
+    def KML_COORDINATES_TAG(self) -> str:
+        return f"{self.KML_SCHEMA}coordinates"
+
     # Extended syntax xpaths
 
-    @property
+    @cached_property
     def KML_GX_TRACK_XPATH(self) -> str:
         return f"./{self.KML_GX_SCHEMA}Track"
 
-    @property
+    @cached_property
     def KML_GX_COORDS_XPATH(self) -> str:
         return f"./{self.KML_GX_SCHEMA}coord"
 
+    @cached_property
+    def KML_GX_TRACK_TAG(self) -> str:
+        return f"{self.KML_GX_SCHEMA}Track"
 
-@dataclass
+    @cached_property
+    def KML_GX_COORD_TAG(self) -> str:
+        return f"{self.KML_GX_SCHEMA}coord"
+
+
+@dataclass(slots=True)
 class Geometry(ABC):
     """
     Abstract Base Class for any supported geometric object.
@@ -177,18 +226,24 @@ class Geometry(ABC):
 
 
 @Geometry.register
-@dataclass
+@dataclass(slots=True)
 class Point(Geometry):
     """
     A simple 2D Point.
+
+    Points are created for every vertex of every geometry. Therefore they use
+    slots and check the coordinates in their own `__init__` instead of an
+    additional `__post_init__` call.
     """
 
     lat: float
     lng: float
 
-    def __post_init__(self):
-        assert -90.0 <= self.lat <= 90.0
-        assert -180.0 <= self.lng <= 180.0
+    def __init__(self, lat: float, lng: float):
+        assert -90.0 <= lat <= 90.0
+        assert -180.0 <= lng <= 180.0
+        self.lat = lat
+        self.lng = lng
 
     @property
     def wkt_type(self) -> str:
@@ -203,8 +258,14 @@ class Point(Geometry):
     @staticmethod
     def from_kml(node: ET.Element, xpath: KMLXPathHelper) \
             -> Iterator['Point']:
-        for el in node.iterfind(xpath.KML_POINT_XPATH):
-            yield Point.from_kml_coords(el.text or "")
+        # Like node.iterfind(xpath.KML_POINT_XPATH)
+        point_tag = xpath.KML_POINT_TAG
+        coords_tag = xpath.KML_COORDINATES_TAG
+        for point_el in node:
+            if point_el.tag == point_tag:
+                for el in point_el:
+                    if el.tag == coords_tag:
+                        yield Point.from_kml_coords(el.text or "")
 
     def to_wkt(self, geometry_type: bool = True) -> str:
         return (self.wkt_type if geometry_type else '') + \
@@ -229,27 +290,39 @@ class LineString(Geometry):
 
     @staticmethod
     def from_kml_coords(coords_str: str) -> Optional['LineString']:
-        members: list[Point] = [
-            Point.from_kml_coords(point)
-            for point in coords_str.split()
-            if point
-        ]
+        # Same as Point.from_kml_coords for each whitespace separated tuple,
+        # but inlined because rings may have many thousand points
+        members: list[Point] = []
+        append = members.append
+        for point in coords_str.split():
+            coords = point.split(",")
+            append(Point(float(coords[1]), float(coords[0])))
         if len(members) >= 2:
             return LineString(members)
 
     @staticmethod
     def from_kml(node: ET.Element, xpath: KMLXPathHelper) \
             -> Iterator['LineString']:
-        for el in node.iterfind(xpath.KML_LINE_XPATH):
-            line = LineString.from_kml_coords(el.text or "")
-            if line:
-                yield line
+        # Like node.iterfind(xpath.KML_LINE_XPATH)
+        line_tag = xpath.KML_LINE_TAG
+        coords_tag = xpath.KML_COORDINATES_TAG
+        for line_el in node:
+            if line_el.tag == line_tag:
+                for el in line_el:
+                    if el.tag == coords_tag:
+                        line = LineString.from_kml_coords(el.text or "")
+                        if line:
+                            yield line
 
         # Also try the extended track syntax
-        for track_el in node.iterfind(xpath.KML_GX_TRACK_XPATH):
+        track_tag = xpath.KML_GX_TRACK_TAG
+        coord_tag = xpath.KML_GX_COORD_TAG
+        for track_el in node:
+            if track_el.tag != track_tag:
+                continue
             members: list[Point] = []
-            for el in track_el.iterfind(xpath.KML_GX_COORDS_XPATH):
-                if el.text:
+            for el in track_el:
+                if el.tag == coord_tag and el.text:
                     parts = el.text.split()
                     members.append(
                         Point(lng=float(parts[0]), lat=float(parts[1])))
@@ -257,7 +330,9 @@ class LineString(Geometry):
                 yield LineString(members)
 
     def to_wkt(self, geometry_type: bool = True) -> str:
-        coords = (f"{member.lng} {member.lat}" for member in self.members)
+        # str.join needs a list anyway, building it directly is faster than
+        # passing a generator
+        coords = [f"{member.lng} {member.lat}" for member in self.members]
         return f"{self.wkt_type if geometry_type else ''}({', '.join(coords)})"
 
 
@@ -280,7 +355,10 @@ class Polygon(Geometry):
     def from_kml(node: ET.Element, xpath: KMLXPathHelper) \
             -> Iterator['Polygon']:
         # Outer
-        for el in node.iterfind(xpath.KML_POLYGON_XPATH):
+        polygon_tag = xpath.KML_POLYGON_TAG
+        for el in node:
+            if el.tag != polygon_tag:
+                continue
             el_outer = el.find(xpath.KML_POLYGON_OUTER_XPATH)
             if el_outer is None:
                 continue
@@ -327,17 +405,22 @@ class GeometryCollection(Geometry):
         Checks if all members are geometries of the same primitive type,
         if yes, returns the type, otherwise returns None.
         """
-        geometry_types: set[str] = set(
-            member.wkt_type for member in self.members
-        )
-        if len(geometry_types) == 1:
-            geometry_type = tuple(geometry_types)[0]
-            if geometry_type in ("POINT", "LINESTRING", "POLYGON"):
-                return geometry_type
+        if not self.members:
+            return None
+        # Stop at the first member of a different type
+        geometry_type = self.members[0].wkt_type
+        for member in self.members:
+            if member.wkt_type != geometry_type:
+                return None
+        if geometry_type in ("POINT", "LINESTRING", "POLYGON"):
+            return geometry_type
 
     @property
     def wkt_type(self) -> str:
-        homogeneous = self.homogeneous()
+        return self.__wkt_type(self.homogeneous())
+
+    @staticmethod
+    def __wkt_type(homogeneous: Optional[str]) -> str:
         if homogeneous:
             return "MULTI" + homogeneous
         else:
@@ -346,7 +429,10 @@ class GeometryCollection(Geometry):
     @staticmethod
     def from_kml(node: ET.Element, xpath: KMLXPathHelper) \
             -> Iterator[Geometry]:
-        for el in node.iterfind(xpath.KML_MULTI_XPATH):
+        multi_tag = xpath.KML_MULTI_TAG
+        for el in node:
+            if el.tag != multi_tag:
+                continue
             members = list(Point.from_kml(el, xpath)) + \
                 list(LineString.from_kml(el, xpath)) + \
                 list(Polygon.from_kml(el, xpath))
@@ -355,11 +441,15 @@ class GeometryCollection(Geometry):
                 yield GeometryCollection(members)
 
     def to_wkt(self, geometry_type: bool = True) -> str:
-        heterogen = self.homogeneous() is None
-        content = ', '.join(
+        # Check the members only once for both the type and the content
+        homogeneous = self.homogeneous()
+        heterogen = homogeneous is None
+        content = ', '.join([
             member.to_wkt(heterogen) for member in self.members
-        )
-        return f"{self.wkt_type if geometry_type else ''}({content})"
+        ])
+        if geometry_type:
+            return f"{self.__wkt_type(homogeneous)}({content})"
+        return f"({content})"
 
 
 @dataclass
@@ -376,34 +466,45 @@ class KMLPlacemark:
     @staticmethod
     def from_kml(node: ET.Element, xpath: KMLXPathHelper) \
             -> list['KMLPlacemark']:
+        result: list['KMLPlacemark'] = []
+        for el in node.iterfind(xpath.KML_PLACEMARK_XPATH):
+            if type(el) is ET.Element:
+                placemark = KMLPlacemark.from_kml_placemark(el, xpath)
+                if placemark:
+                    result.append(placemark)
+        return result
+
+    @staticmethod
+    def from_kml_placemark(el: ET.Element, xpath: KMLXPathHelper) \
+            -> Optional['KMLPlacemark']:
+        """
+        Processes a single <Placemark> element. Returns None if it does not
+        contain a supported geometry.
+        """
         def get_text(_el: ET.Element, _xpath: str) -> Optional[str]:
             el_text = _el.find(_xpath)
             if type(el_text) is ET.Element and el_text.text:
                 return el_text.text
 
-        result: list['KMLPlacemark'] = []
-        for el in node.iterfind(xpath.KML_PLACEMARK_XPATH):
-            if type(el) is ET.Element:
-                # Geometry
-                geometry = list(Point.from_kml(el, xpath)) + \
-                    list(LineString.from_kml(el, xpath)) + \
-                    list(Polygon.from_kml(el, xpath)) + \
-                    list(GeometryCollection.from_kml(el, xpath))
-                assert len(geometry) <= 1, \
-                    "The KML standard allows only one geometry per placemark."
-
-                # Metadata
-                placemark_id = el.attrib.get("id", None)
-                name = get_text(el, xpath.KML_NAME_XPATH)
-                description = get_text(el, xpath.KML_DESCRIPTION_XPATH)
-                # ... could add "./TimeStamp/when"
-
-                # Is valid?
-                if geometry:
-                    result.append(KMLPlacemark(
-                        geometry[0], placemark_id, name, description
-                    ))
-        return result
+        # Geometry
+        geometry = list(Point.from_kml(el, xpath)) + \
+            list(LineString.from_kml(el, xpath)) + \
+            list(Polygon.from_kml(el, xpath)) + \
+            list(GeometryCollection.from_kml(el, xpath))
+        assert len(geometry) <= 1, \
+            "The KML standard allows only one geometry per placemark."
+
+        # Metadata
+        placemark_id = el.attrib.get("id", None)
+        name = get_text(el, xpath.KML_NAME_XPATH)
+        description = get_text(el, xpath.KML_DESCRIPTION_XPATH)
+        # ... could add "./TimeStamp/when"
+
+        # Is valid?
+        if geometry:
+            return KMLPlacemark(
+                geometry[0], placemark_id, name, description
+            )
 
 
 @Dataset.register
@@ -455,17 +556,9 @@ class KMLDataset(Dataset):
         Converts a Keyhole-Markup-Language (KML) file containing <Placemark>s
         with supported geometries to RDF triples. See: `Dataset.rdf`
         """
-        content = "\n".join(self.content())
-        xpath = KMLXPathHelper.from_kml_source(content)
-
-        root = ET.fromstring(content)
-        placemarks = KMLPlacemark.from_kml(root, xpath)
-
-        if KML_PARSING_VERBOSE:
-            logger.info("Processed tree contains %d placemarks",
-                        len(placemarks))
-
-        for placemark in placemarks:
+        count = 0
+        for placemark in self.placemarks():
+            count += 1
             if KML_PARSING_VERBOSE:
                 logger.info("Parsed: %s", repr(placemark))
 
@@ -482,14 +575,61 @@ class KMLDataset(Dataset):
             if placemark.placemark_id:
                 yield (subj, IDENTIFIER, add_datatype(placemark.placemark_id))
 
+            # The WKT is built only once for the triple and the callback
+            wkt = placemark.geometry.to_wkt()
             yield (subj, HAS_GEOMETRY, subj_geo)
-            yield (subj_geo, AS_WKT, placemark.geometry.wkt_literal())
+            yield (subj_geo, AS_WKT, f"\"{wkt}\"^^{WKT_LITERAL_TYPE}")
 
             if self.aux_geo_callback:
-                self.aux_geo_callback(
-                    subj,
-                    placemark.geometry.wkt_literal(False)
-                )
+                self.aux_geo_callback(subj, wkt)
+
+        if KML_PARSING_VERBOSE:
+            logger.info("Processed file contains %d placemarks", count)
+
+    def placemarks(self) -> Iterator[KMLPlacemark]:
+        """
+        Parses the KML file incrementally and yields every <Placemark> with a
+        supported geometry as soon as its end tag has been read. Processed
+        placemarks are removed from the parsed tree, so it does not grow with
+        the number of placemarks in the file.
+        """
+        # The XML parser decodes the file itself
+        parser = ET.XMLPullParser(events=("start-ns", "start", "end"))
+
+        def events() -> Iterator[tuple[str, Any]]:
+            for block in self.content_bytes():
+                parser.feed(block)
+                yield from parser.read_events()
+            parser.close()
+            yield from parser.read_events()
+
+        # The namespaces are declared before the elements using them. The
+        # XPath helper is rebuilt if a namespace is declared later on.
+        namespaces: dict[str, str] = {}
+        xpath: Optional[KMLXPathHelper] = None
+        placemark_tag = ""
+
+        # Elements whose end tag has not been read yet. ElementTree has no
+        # parent pointers, so this is needed to remove finished placemarks.
+        open_elements: list[ET.Element] = []
+        for event, node in events():
+            if event == "start-ns":
+                namespaces[node[0]] = node[1]
+                xpath = None
+                continue
+            if xpath is None:
+                xpath = KMLXPathHelper.from_namespaces(namespaces)
+                placemark_tag = xpath.KML_PLACEMARK_TAG
+            if event == "start":
+                open_elements.append(node)
+                continue
+            open_elements.pop()
+            if node.tag == placemark_tag:
+                placemark = KMLPlacemark.from_kml_placemark(node, xpath)
+                if open_elements:
+                    open_elements[-1].remove(node)
+                if placemark:
+                    yield placemark
 
 
 def parse_arguments(argv: Optional[Sequence[str]]) -> argparse.Namespace:
@@ -573,8 +713,10 @@ def main(argv: Optional[Sequence[str]] = None):
             kml_files = [fn for fn in zf.namelist() if fn.endswith(".kml")]
             assert len(kml_files) == 1, \
                 "Valid KMZ must contain exactly one .kml file"
-            with zf.open(kml_files[0], "r") as cf, open(extracted, "w") as ef:
-                ef.write(cf.read().decode("utf-8"))
+            # Copy the raw bytes in blocks, the XML parser decodes them
+            with zf.open(kml_files[0], "r") as cf, \
+                    open(extracted, "wb") as ef:
+                copyfileobj(cf, ef, CONTENT_BUFFER_SIZE)
         logger.info("Extracted file written to '%s'", extracted)
         input_ = extracted
     elif input_.endswith(".kmz"):
@@ -582,14 +724,16 @@ def main(argv: Optional[Sequence[str]] = None):
                        "not given. Treating as KML.")
 
     # Generate and emit triples
-    with (open(args.aux_geo[0], "w") if args.aux_geo else nullcontext()) \
-            as agf:
+    # The aux geo file is written in large blocks
+    with (open(args.aux_geo[0], "w", encoding="utf-8",
+               buffering=CONTENT_BUFFER_SIZE)
+          if args.aux_geo else nullcontext()) as agf:
         aux_geo_count = 0
 
         def aux_geo_callback(_id: str, _wkt: str):
             nonlocal aux_geo_count
             if args.aux_geo:
-                print(f"{_id}\t{_wkt}", file=agf)
+                agf.write(f"{_id}\t{_wkt}\n")
                 aux_geo_count += 1
 
         d = KMLDataset(dataset, "", input_,
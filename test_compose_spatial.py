@@ -28,12 +28,14 @@ import unittest
 from unittest.mock import patch, mock_open
 from email.message import Message
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
 from compose_spatial import ComposeSpatialHTTPRequestHandler, \
     ComposeSpatialHTTPServer, QueryConfig, Template, ReplaceRule, \
     SpatialSearch, SpatialSearchConfig, ProvidedValues, GroupTemplate, \
     RightShard, cli_main, group, clean_name, get, indent, Mime, guess_type, \
     get_config_and_queries, get_all_configs, get_file_contents, main, \
-    serve_main
+    serve_main, multi_replace, LazyFilesCache
 
 PROGRAM_DIR = Path(__file__).parent.resolve()
 assert PROGRAM_DIR.is_dir(), "Unit tests cannot be run from ZIP module"
@@ -212,6 +214,19 @@ class TestComposeSpatial(ComposeSpatialTestCase):
                                     "Maximum replace depth exceeded"):
             t2.compose(files, groups)
 
+        replace3 = [ReplaceRule("%SEARCH1%", "%SEARCH3%", None),
+                    ReplaceRule("%SEARCH3%", "%SEARCH1%", None)]
+        t3 = Template("example.rq", replace3)
+        with self.assertRaisesRegex(RecursionError,
+                                    "Maximum replace depth exceeded"):
+            t3.compose(files, groups)
+
+        # A later rule may produce input for an earlier one
+        replace4 = [ReplaceRule("%SEARCH2%", "Done", None),
+                    ReplaceRule("%SEARCH1%", "%SEARCH2%", None)]
+        t4 = Template("example.rq", replace4)
+        self.assertNotIn("%SEARCH", t4.compose(files, groups))
+
     def test_replace_rule(self):
         # Invariants
         with self.assertRaises(AssertionError):
@@ -243,6 +258,11 @@ class TestComposeSpatial(ComposeSpatialTestCase):
                              "replace.rq": "Something\\1."
                          }, "xyz%xyz%xyz"), "xyzSomething\\1.xyz")
 
+        # Escaped replace file contents are cached per contents
+        r = ReplaceRule("%(\\w+)%", None, "replace.rq")
+        self.assertEqual(r.apply({"replace.rq": "a\\1"}, "%x%"), "a\\1")
+        self.assertEqual(r.apply({"replace.rq": "b\\1"}, "%x%"), "b\\1")
+
     def test_spatial_search_config(self):
         # Invariants
         with self.assertRaises(AssertionError):
@@ -319,6 +339,7 @@ class TestComposeSpatial(ComposeSpatialTestCase):
         r2 = RightShard("xyz.rq",
                         ["?x", "?y", "?z"])
         self.assertListEqual(r2.payload, ["?x", "?y", "?z"])
+        self.assertEqual(r2.name, "xyz")
         self.assertEqual(r2.compose_payload(), "?x, ?y, ?z")
         self.assertTrue(r2.includes_variable("?x"))
         self.assertTrue(r2.includes_variable("?y"))
@@ -358,6 +379,7 @@ class TestComposeSpatial(ComposeSpatialTestCase):
             SpatialSearch.from_config(_c)
 
         self.assertEqual(s.apply_name_template("left", "right"), "left_right")
+        self.assertEqual(s.apply_name_template("_l_", "_r__"), "l___r")
 
         #
         qname, query, select = s.compose_single(
@@ -560,6 +582,15 @@ class TestUtils(ComposeSpatialTestCase):
             self.assertIn(f, files)
         self.assertDictEqual(conf, json.loads(tc))
 
+        with TemporaryDirectory() as tmp:
+            zip_pth = str(Path(tmp, "input.zip"))
+            with ZipFile(zip_pth, "w") as zf:
+                for f in ["test_compose.json", *files]:
+                    zf.write(PROGRAM_DIR / "test" / f, f)
+            self.assertTupleEqual(
+                get_config_and_queries(zip_pth, "test_compose.json"),
+                (conf, files))
+
         self.assertListEqual(
             get_all_configs(str(PROGRAM_DIR / "test")),
             ["test_compose.json"])
@@ -578,6 +609,10 @@ class TestUtils(ComposeSpatialTestCase):
         self.assertEqual(guess_type("index.html"), Mime.HTML)
         self.assertEqual(guess_type("something.htm"), Mime.HTML)
         self.assertEqual(guess_type("something.json"), Mime.JSON)
+        self.assertEqual(guess_type("INDEX.HTML"), Mime.HTML)
+        self.assertEqual(guess_type("json"), Mime.PLAIN)
+        self.assertEqual(guess_type("dir.js/file"), Mime.PLAIN)
+        self.assertEqual(guess_type(Path("dir", "file.css")), Mime.CSS)
 
     def test_group(self):
         a = [1, 2, 3, 4, 5]
@@ -602,6 +637,48 @@ class TestUtils(ComposeSpatialTestCase):
         self.assertEqual(clean_name("exa.rq.mple.sparql"), "exa.rq.mple")
         self.assertEqual(clean_name(""), "")
 
+    def test_multi_replace(self):
+        self.assertEqual(multi_replace("%A% and %B%", {
+            "%A%": "x",
+            "%B%": "y"
+        }), "x and y")
+        self.assertEqual(multi_replace("%A%%A%", {"%A%": "%B%", "%B%": "z"}),
+                         "%B%%B%")
+        self.assertEqual(multi_replace("%AB% %A%", {"%A": "1", "%AB%": "2"}),
+                         "2 1%")
+        self.assertEqual(multi_replace("a\\1", {"a": "\\2"}), "\\2\\1")
+        self.assertEqual(multi_replace("abc", {}), "abc")
+        self.assertEqual(multi_replace("abc", {"": "x"}), "abc")
+
+    def test_lazy_files_cache(self):
+        calls = 0
+
+        def loader() -> str:
+            nonlocal calls
+            calls += 1
+            return "content"
+
+        c = LazyFilesCache()
+        c.register("a.rq", loader)
+        c.put("b.json", "{}")
+        self.assertEqual(calls, 0)
+        self.assertIn("a.rq", c)
+        self.assertNotIn("x.rq", c)
+        self.assertEqual(calls, 0)
+        self.assertEqual(c["a.rq"], "content")
+        self.assertEqual(c["a.rq"], "content")
+        self.assertEqual(calls, 1)
+        self.assertEqual(c["b.json"], "{}")
+        self.assertListEqual(list(c), ["a.rq", "b.json"])
+        self.assertEqual(len(c), 2)
+        self.assertIsNone(c.get("x.rq"))
+        with self.assertRaises(KeyError):
+            c["x.rq"]
+
+        b = LazyFilesCache[bytes]()
+        b.put("c.css", b"body {}")
+        self.assertEqual(b["c.css"], b"body {}")
+
     def test_get(self):
         nested = {
             "a": {
@@ -754,8 +831,23 @@ class TestServer(ComposeSpatialTestCase):
                 and type(_call.args[1]) is str
             }
 
+            # Caching headers are tested separately
+            content_headers = {
+                key: val for key, val in actual_res_headers.items()
+                if key not in ("etag", "cache-control")
+            }
+
+            if res_status == 304:
+                # Not modified: no content
+                self.assertDictEqual(content_headers, {})
+                rh.wfile.seek(0)
+                self.assertEqual(rh.wfile.read(), b"")
+                rh.rfile.close()
+                rh.wfile.close()
+                return (actual_res_headers, "")
+
             if res_body is not None:
-                self.assertDictEqual(actual_res_headers, {
+                self.assertDictEqual(content_headers, {
                     'content-type': res_mime,
                     'content-length': str(len(res_body))
                 })
@@ -800,6 +892,17 @@ class TestServer(ComposeSpatialTestCase):
         self.assertTrue(h.knows("test.rq"))
         self.assertEqual(h.get("restaurant.rq"),
                          self.get_exp_file("restaurant.rq"))
+        enc = h.get_encoded("restaurant.rq")
+        self.assertEqual(enc, self.get_exp_file("restaurant.rq").encode())
+        self.assertIs(h.get_encoded("restaurant.rq"), enc)
+        with open(PROGRAM_DIR / "compose" / "index.html", "rb") as f:
+            index = f.read()
+        self.assertEqual(h.get_encoded("index.html"), index)
+        self.assertEqual(h.get("index.html"), index.decode())
+        for fn in ("configs.json", "selects.json"):
+            compact = json.dumps(json.loads(h.get(fn)), separators=(",", ":"))
+            self.assertEqual(h.get(fn), compact)
+            self.assertEqual(h.get_encoded(fn), compact.encode())
         # Prevent address already in use when opening second server
 
         h2 = self.server2
@@ -808,6 +911,65 @@ class TestServer(ComposeSpatialTestCase):
         self.assertEqual(h2.get("test_compose_copy.json"),
                          self.get_exp_file("test_compose_copy.json"))
 
+    @patch("compose_spatial.logger.info", lambda *_: None)
+    def test_server_missing_file(self):
+        # Files are read lazily, but missing ones are detected at startup
+        with open(PROGRAM_DIR / "test" / "test_serve.json", "r") as f:
+            serve = json.load(f)
+        serve["shards"].append("missing.rq")
+        files = ["test_compose.json", "template.rq", "test.rq", "station.rq",
+                 "restaurant.rq", "group_template.rq"]
+        with TemporaryDirectory() as tmp:
+            for f in files:
+                Path(tmp, f).write_bytes(
+                    (PROGRAM_DIR / "test" / f).read_bytes())
+            Path(tmp, "serve.json").write_text(json.dumps(serve))
+            with self.assertRaisesRegex(AssertionError, "missing.rq"):
+                ComposeSpatialHTTPServer(tmp, "test_compose.json",
+                                         "serve.json")
+
+            zip_pth = str(Path(tmp, "input.zip"))
+            with ZipFile(zip_pth, "w") as zf:
+                for f in [*files, "serve.json"]:
+                    zf.write(Path(tmp, f), f)
+            with self.assertRaisesRegex(AssertionError, "missing.rq"):
+                ComposeSpatialHTTPServer(zip_pth, "test_compose.json",
+                                         "serve.json")
+
+    @patch("compose_spatial.logger.info", lambda *_: None)
+    def test_compose_cache(self):
+        # The template of the example config is empty. Use a non-empty one
+        # and let both the spatial search and a replace rule change it.
+        with open(PROGRAM_DIR / "test" / "test_compose.json", "r") as f:
+            config = json.load(f)
+        config["template"] = {
+            "filename": "restaurant.rq",
+            "replace": [{"search": "<bla>", "replace": "<demo>"}]
+        }
+        config["spatial_searches"][0]["template_pattern"] = "xyz"
+        body = json.dumps(config).encode()
+        exp = self.server.compose(json.loads(body)).encode()
+        self.assertIn(b"?restaurant <demo> <restaurant> .", exp)
+        self.assertNotIn(b"xyz", exp)
+
+        with patch.object(self.server, "compose",
+                          wraps=self.server.compose) as mock_compose:
+            res = self.server.compose_request(body)
+            self.assertEqual(res, exp)
+            mock_compose.assert_called_once()
+
+            # Answered from the cache without composing again
+            self.assertIs(self.server.compose_request(body), res)
+            mock_compose.assert_called_once()
+
+            # A different request is composed
+            config["template"]["replace"][0]["replace"] = "<other>"
+            res2 = self.server.compose_request(json.dumps(config).encode())
+            self.assertEqual(mock_compose.call_count, 2)
+            self.assertIn(b"?restaurant <other> <restaurant> .", res2)
+            self.assertEqual(self.server.compose_request(body), exp)
+            self.assertEqual(mock_compose.call_count, 2)
+
     @patch("compose_spatial.logger.info", lambda *_: None)
     def test_request_handler_get(self):
         exp = self.get_exp_file("restaurant.rq")
@@ -838,6 +1000,32 @@ class TestServer(ComposeSpatialTestCase):
         self.helper_req_handler(SupportedRequestMethod.GET, "/style.css",
                                 "", {}, "text/css", exp4, 200)
 
+    @patch("compose_spatial.logger.info", lambda *_: None)
+    def test_request_handler_etag(self):
+        exp = self.get_exp_file("restaurant.rq")
+        headers, _ = self.helper_req_handler(
+            SupportedRequestMethod.GET, "/restaurant.rq", "", {},
+            "application/sparql-query", exp, 200)
+        etag = headers["etag"]
+        self.assertRegex(etag, r'^"[0-9a-f]{16}"$')
+        self.assertEqual(etag, self.server.get_etag("restaurant.rq"))
+        self.assertEqual(headers["cache-control"], "no-cache")
+
+        # Matching ETag: not modified
+        for if_none_match in (etag, "W/" + etag, '"x", ' + etag, "*"):
+            headers, _ = self.helper_req_handler(
+                SupportedRequestMethod.GET, "/restaurant.rq", "",
+                {"If-None-Match": if_none_match}, "", None, 304)
+            self.assertEqual(headers["etag"], etag)
+
+        # Different ETag: full response
+        self.helper_req_handler(
+            SupportedRequestMethod.GET, "/restaurant.rq", "",
+            {"If-None-Match": '"x"'}, "application/sparql-query", exp, 200)
+
+        # Different files have different ETags
+        self.assertNotEqual(self.server.get_etag("index.html"), etag)
+
     @patch("compose_spatial.logger.info", lambda *_: None)
     def test_request_handler_post(self):
         self.helper_req_handler(SupportedRequestMethod.POST, "/index.html",
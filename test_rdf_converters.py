@@ -20,23 +20,31 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import bz2
+import csv
+from array import array
 from dataclasses import dataclass
 from typing import Iterator, Optional, Any
 import unittest
+import weakref
 from unittest.mock import patch
+import dataset
 from dataset import PREFIXES, Dataset, Prefix, Triple, all_prefixes, \
-    add_datatype, next_id, TYPE, triple
+    add_datatype, next_id, TYPE, triple, ParallelBZ2Writer, GLOBAL_COUNTER, \
+    is_word, is_prefixed_name
 from kml2rdf import KMLDataset, KMLPlacemark, KMLXPathHelper, \
     Geometry, Point, LineString, Polygon, GeometryCollection, \
     main as kml2rdf_main
 from csv2rdf import CSVDataset, main as csv2rdf_main, \
-    set_warn_missing_col_mapping
-from gtfs2rdf import GTFSFeed, main as gtfs2rdf_main
+    set_warn_missing_col_mapping, compile_values_mapping, \
+    values_lookup_table
+from gtfs2rdf import GTFSFeed, GTFSTableDataset, main as gtfs2rdf_main, \
+    replace_nalph, shape_points, gtfs_date
 from election2rdf import Election, main as election2rdf_main
 from abc import ABC
 from tempfile import TemporaryDirectory
 import xml.etree.ElementTree as ET
 from pathlib import Path
+from zipfile import ZipFile
 import os
 import shutil
 import json
@@ -64,8 +72,37 @@ class TestUtils(unittest.TestCase):
                          '"2024-11-17T18:19:50.999Z"^^xsd:dateTime')
         self.assertEqual(add_datatype("POINT(7.9 49.7)"),
                          '"POINT(7.9 49.7)"^^geo:wktLiteral')
+        self.assertEqual(add_datatype(" point ( -1 2.5 ) x"),
+                         '"point ( -1 2.5 ) x"^^geo:wktLiteral')
+        self.assertEqual(add_datatype("12\n"), '"12"^^xsd:integer')
+        self.assertEqual(add_datatype(" 12"), '"12"')
+        self.assertEqual(add_datatype("1.5.2"), '"1.5.2"')
+        self.assertEqual(add_datatype("\xa0Point(1 2)"),
+                         '"Point(1 2)"^^geo:wktLiteral')
+        self.assertEqual(add_datatype("\u0663"), '"\\u0663"^^xsd:integer')
+        self.assertEqual(add_datatype("x 12"), '"x 12"')
         self.assertEqual(add_datatype(None), '""')  # type: ignore
 
+    def test_add_datatype_cache(self):
+        dataset._datatype_cache.clear()
+        self.assertEqual(add_datatype("03.09.1989"), '"1989/09/03"^^xsd:date')
+        self.assertEqual(add_datatype("03.09.1989"), '"1989/09/03"^^xsd:date')
+        self.assertIn("03.09.1989", dataset._datatype_cache)
+
+        # Long literals are not cached
+        long = "x" * (dataset.DATATYPE_CACHE_MAX_LEN + 1)
+        self.assertEqual(add_datatype(long), f'"{long}"')
+        self.assertNotIn(long, dataset._datatype_cache)
+
+        # The cache is cleared when it is full
+        with patch("dataset.DATATYPE_CACHE_SIZE", 2):
+            dataset._datatype_cache.clear()
+            for i in range(5):
+                self.assertEqual(add_datatype(str(i)),
+                                 f'"{i}"^^xsd:integer')
+                self.assertLessEqual(len(dataset._datatype_cache), 2)
+            self.assertEqual(add_datatype("4"), '"4"^^xsd:integer')
+
     def test_prefix(self):
         p = Prefix("abc", "http://example.com/abc#")
         p2 = Prefix("abc", "http://example.com/xyz#")
@@ -82,6 +119,18 @@ class TestUtils(unittest.TestCase):
         self.assertNotEqual(p, p2)
 
         self.assertEqual(len(set((p, p2, p3))), 3)
+        self.assertEqual(hash(p3), hash(p4))
+        self.assertNotEqual(p, "abc")
+        self.assertEqual(p.prefix, "abc")
+        self.assertEqual(p2.iri, "http://example.com/xyz#")
+        self.assertEqual(repr(p3),
+                         "Prefix(prefix='xyz', iri='http://example.com/xyz#')")
+
+        # Immutable
+        with self.assertRaises(AttributeError):
+            p.prefix = "xyz"  # type: ignore
+        with self.assertRaises(AttributeError):
+            p.other = "xyz"  # type: ignore
 
         with self.assertRaises(AssertionError):
             Prefix("", "")
@@ -116,12 +165,59 @@ class TestUtils(unittest.TestCase):
         # Must be sorted for deterministic output
         self.assertLess(ap.index(p_expect), ap.index(p3_expect))
 
+        # Changes to the set of prefixes are reflected
+        self.assertListEqual(list(all_prefixes()), ap)
+        PREFIXES.remove(p3)
+        self.assertNotIn(p3_expect, list(all_prefixes()))
+        PREFIXES.add(p3)
+
+    def test_is_word(self):
+        self.assertTrue(is_word("abc_1"))
+        self.assertTrue(is_word("_"))
+        self.assertTrue(is_word("1ä"))
+        self.assertFalse(is_word(""))
+        self.assertFalse(is_word("a-b"))
+        self.assertFalse(is_word("abc\n"))
+        self.assertFalse(is_word("a:b"))
+
+        self.assertTrue(is_prefixed_name("a:b"))
+        self.assertTrue(is_prefixed_name("a_1:"))
+        self.assertFalse(is_prefixed_name("a"))
+        self.assertFalse(is_prefixed_name(":b"))
+        self.assertFalse(is_prefixed_name("a:b:c"))
+        self.assertFalse(is_prefixed_name("a:\n"))
+
     def test_next_id(self):
         i = int(next_id())
         for inc in range(1, 10):
             n = next_id()
             self.assertEqual(n, str(i + inc))
 
+        # The counter may also be advanced directly
+        self.assertEqual(next(GLOBAL_COUNTER), i + 10)
+        self.assertEqual(next_id(), str(i + 11))
+
+    def test_parallel_bz2_writer(self):
+        with TemporaryDirectory() as d:
+            # Multiple chunks are written as consecutive bzip2 streams
+            fn = str(Path(d, "multi.bz2"))
+            with ParallelBZ2Writer(fn, chunk_size=10, workers=2) as f:
+                for i in range(100):
+                    f.write(f"line {i}\n".encode())
+            with bz2.open(fn) as f:
+                self.assertEqual(f.read().decode(), "".join(
+                    f"line {i}\n" for i in range(100)))
+            with open(fn, "rb") as f:
+                self.assertGreater(f.read().count(b"BZh9"), 2)
+
+            # Empty output is a valid bzip2 file
+            fn = str(Path(d, "empty.bz2"))
+            f = ParallelBZ2Writer(fn)
+            f.close()
+            f.close()
+            with bz2.open(fn) as f:
+                self.assertEqual(f.read(), b"")
+
     def test_triple(self):
         self.assertEqual(triple(("a", "b", "c")), "a b c .\n")
 
@@ -192,6 +288,19 @@ class TestDataset(unittest.TestCase):
         d.get_data()
         self.assertEqual(list(d.content()), ["Hello World\n"])
 
+        # content_bytes: raw blocks without byte order mark
+        with TemporaryDirectory() as tmp:
+            fn = str(Path(tmp, "bom.txt"))
+            with open(fn, "wb") as f:
+                f.write(b"\xef\xbb\xbfHello\r\nW\xc3\xb6rld\n")
+            d = DummyDataset(_dataset="abc", _command=None,
+                             _store_filename=fn,
+                             _primary_prefix="rdf:", parent="test")
+            d.get_data()
+            self.assertEqual(b"".join(d.content_bytes()),
+                             b"Hello\r\nW\xc3\xb6rld\n")
+            self.assertEqual(list(d.content()), ["Hello\n", "Wörld\n"])
+
         # clean_prefix and type_str
         d = DummyDataset(_dataset="abc", _command="echo 'Hello World'",
                          _store_filename="test/hello3.txt",
@@ -224,6 +333,27 @@ class TestDataset(unittest.TestCase):
                 "to end with '.ttl.bz2'"
             self.assertEqual(log.output, [expect_warn])
 
+        # to_file writes triples in batches
+        @Dataset.register
+        @dataclass
+        class CountingDataset(Dataset):
+            def rdf(self) -> Iterator[Triple]:
+                for i in range(5):
+                    yield ("dummy", "count", f"\"{i}ü\"")
+
+        d = CountingDataset(_dataset="abc", _command="echo 'Hello World'",
+                            _store_filename="test/hello3.txt",
+                            _primary_prefix="rdf:abc_def", parent="test")
+        with TemporaryDirectory() as tmp, \
+                patch("dataset.TO_FILE_BATCH_SIZE", 2):
+            fn = str(Path(tmp, "counting.ttl.bz2"))
+            self.assertEqual(d.to_file(fn), 5)
+            with bz2.open(fn) as f:
+                lines = f.read().decode("utf-8").splitlines()
+        self.assertEqual([
+            line for line in lines if not line.startswith("@prefix")
+        ], [f"dummy count \"{i}ü\" ." for i in range(5)])
+
     @patch("dataset.logger.info", lambda *_: None)
     def test_csv_dataset(self):
         # test general features and col mapping
@@ -309,6 +439,148 @@ class TestDataset(unittest.TestCase):
                 f'for {col}' for col in ('a', 'b', 'c', 'd', 'e')])
         set_warn_missing_col_mapping(False)
 
+    @patch("dataset.logger.info", lambda *_: None)
+    def test_csv_dataset_irregular_rows(self):
+        rows: list[dict[str, str]] = []
+
+        def et_cb(_: CSVDataset, subj: str, row: dict[str, str]) \
+                -> Iterator[Triple]:
+            rows.append(row)
+            return iter(())
+
+        with TemporaryDirectory() as d:
+            fn = str(Path(d, "irregular.csv"))
+            with open(fn, "w") as f:
+                f.write("\nid,x,y\n1,a,b\n\n2,c\n3,,d,e\n")
+            c = CSVDataset(
+                _dataset="irregular",
+                _command=None,
+                _store_filename=fn,
+                _primary_prefix="test:i",
+                column_mapping={"y": None, "x": "x y"},
+                primary_col="id",
+                extra_triple_callback=et_cb
+            )
+            c.get_data()
+            with self.assertLogs('csv2rdf', level='WARN') as log:
+                triples = list(c.rdf())
+            self.assertListEqual(log.output, [
+                "WARNING:csv2rdf:Dataset irregular. Row with 4 cells, but " +
+                "only 3 columns. The extra cells are ignored."])
+            self.assertListEqual(triples, [
+                ("test:i1", "a", "test:irregular"),
+                ("test:i1", "test:id", "\"1\"^^xsd:integer"),
+                ("test:i1", "\"test:x y\"", "\"a\""),
+                ("test:i2", "a", "test:irregular"),
+                ("test:i2", "test:id", "\"2\"^^xsd:integer"),
+                ("test:i2", "\"test:x y\"", "\"c\""),
+                ("test:i3", "a", "test:irregular"),
+                ("test:i3", "test:id", "\"3\"^^xsd:integer"),
+            ])
+            self.assertListEqual(rows, [
+                {"id": "1", "x": "a", "y": "b"},
+                {"id": "2", "x": "c", "y": None},
+                {"id": "3", "x": "", "y": "d", None: ["e"]}
+            ])
+
+            # Primary column missing in a short row
+            c.primary_col = "y"
+            c.extra_triple_callback = None
+            with self.assertLogs('csv2rdf', level='WARN'):
+                self.assertListEqual([
+                    subj for subj, pred, _ in c.rdf() if pred == TYPE
+                ], ["test:ib", "test:i", "test:id"])
+
+            c.primary_col = "z"
+            with self.assertRaisesRegex(AssertionError, "'z' not found"):
+                list(c.rdf())
+
+    @patch("dataset.logger.info", lambda *_: None)
+    def test_csv_dataset_duplicate_columns(self):
+        rows: list[dict[str, str]] = []
+
+        def et_cb(_: CSVDataset, subj: str, row: dict[str, str]) \
+                -> Iterator[Triple]:
+            rows.append(row)
+            return iter(())
+
+        # Like csv.DictReader: the last value of a repeated column is used,
+        # at the position of the first occurrence of the column
+        with TemporaryDirectory() as d:
+            fn = str(Path(d, "duplicate.csv"))
+            with open(fn, "w") as f:
+                f.write("id,a,b,a,id\n1,x,y,z,2\n3,u,v\n")
+            c = CSVDataset(
+                _dataset="duplicate",
+                _command=None,
+                _store_filename=fn,
+                _primary_prefix="test:d",
+                primary_col="id",
+                extra_triple_callback=et_cb
+            )
+            c.get_data()
+            with open(fn) as f:
+                self.assertListEqual(list(csv.DictReader(f)), [
+                    {"id": "2", "a": "z", "b": "y"},
+                    {"id": None, "a": None, "b": "v"}
+                ])
+            self.assertListEqual(list(c.rdf()), [
+                ("test:d2", "a", "test:duplicate"),
+                ("test:d2", "test:id", "\"2\"^^xsd:integer"),
+                ("test:d2", "test:a", "\"z\""),
+                ("test:d2", "test:b", "\"y\""),
+                ("test:d", "a", "test:duplicate"),
+                ("test:d", "test:b", "\"v\""),
+            ])
+            self.assertListEqual(rows, [
+                {"id": "2", "a": "z", "b": "y"},
+                {"id": None, "a": None, "b": "v"}
+            ])
+
+    def test_compile_values_mapping(self):
+        def repl(m: re.Match) -> str:
+            return m.group(0).upper()
+        compiled = compile_values_mapping({
+            "a": ([("^0*", ""), ("[a-z]+", repl)], False),
+            "b": ([], True)
+        })
+        self.assertEqual(compiled.keys(), {"a", "b"})
+        rules, datatype = compiled["a"]
+        self.assertFalse(datatype)
+        self.assertEqual(rules[0][0], re.compile("^0*"))
+        self.assertEqual(rules[0][1], "")
+        self.assertIs(rules[1][1], repl)
+        self.assertEqual(rules[1][0].sub(rules[1][1], "x1yz"), "X1YZ")
+        self.assertEqual(compiled["b"], ([], True))
+
+    def test_values_lookup_table(self):
+        rules, _ = compile_values_mapping({
+            "a": ([("^0$", "1"), ("^1$", "x"), ("^2$", "y"), ("3", "z")],
+                  True)
+        })["a"]
+        # The rules are applied in order, even for precomputed values
+        self.assertEqual(values_lookup_table(rules),
+                         {"0": "x", "1": "x", "2": "y"})
+        self.assertEqual(values_lookup_table([]), {})
+
+        # Values not in the table are still mapped by the rules
+        with TemporaryDirectory() as d:
+            fn = str(Path(d, "lookup.csv"))
+            with open(fn, "w") as f:
+                f.write('id,a\n1,0\n2,"2\n"\n3,33\n4,5\n')
+            c = CSVDataset(
+                _dataset="lookup",
+                _command=None,
+                _store_filename=fn,
+                _primary_prefix="p:",
+                primary_col="id",
+                values_mapping={"a": ([("^0$", "1"), ("^1$", "x"),
+                                       ("^2$", "y"), ("3", "z")], False)}
+            )
+            c.get_data()
+            self.assertEqual([o for _, p, o in c.rdf() if p == "p:a"],
+                             ["x", "y\n", "zz", "5"])
+
     @patch("dataset.logger.info", lambda *_: None)
     def test_kml_dataset(self):
         i = next_id()
@@ -330,7 +602,12 @@ class TestDataset(unittest.TestCase):
 
         k.get_data()
         subj1 = f"wkgeo:id_prefix_{i1}"
-        self.assertListEqual(list(k.rdf()), [
+        with patch.object(GeometryCollection, "to_wkt", autospec=True,
+                          side_effect=GeometryCollection.to_wkt) as to_wkt:
+            triples = list(k.rdf())
+        # The WKT is only built once for the triple and the aux geo callback
+        to_wkt.assert_called_once()
+        self.assertListEqual(triples, [
             (subj1, "a", "wkgeo:k"),
             (subj1, "rdfs:member", "parent"),
             (subj1, "rdfs:label", "\"example 1.1\""),
@@ -353,6 +630,54 @@ class TestDataset(unittest.TestCase):
              "(12.0 12.25, 12.5 12.25, 12.5 12.5)))")
         ])
 
+    def test_kml_dataset_streaming(self):
+        with TemporaryDirectory() as d:
+            fn = str(Path(d, "stream.kml"))
+            with open(fn, "w") as f:
+                f.write('<kml xmlns="http://earth.google.com/kml/2.2">' +
+                        '<Placemark><name>a</name><Point><coordinates>' +
+                        '1,2</coordinates></Point></Placemark>' +
+                        '<Placemark><name>b</name></Placemark>' +
+                        '<Placemark><Point><coordinates>3,4</coordinates>' +
+                        '</Point></Placemark><broken></kml>')
+            k = KMLDataset(
+                _dataset="stream",
+                _command=None,
+                _store_filename=fn,
+                _primary_prefix="ex:"
+            )
+            k.get_data()
+
+            # Placemarks are yielded before the rest of the file is parsed.
+            # Processed placemarks are removed from the tree.
+            elements: list[weakref.ref] = []
+
+            def from_kml_placemark(el: ET.Element, xpath: KMLXPathHelper):
+                elements.append(weakref.ref(el))
+                return from_kml_placemark_orig(el, xpath)
+
+            from_kml_placemark_orig = KMLPlacemark.from_kml_placemark
+            with patch("kml2rdf.KMLPlacemark.from_kml_placemark",
+                       from_kml_placemark):
+                placemarks = k.placemarks()
+                self.assertEqual(next(placemarks),
+                                 KMLPlacemark(Point(lat=2, lng=1), None, "a",
+                                              None))
+                self.assertEqual(next(placemarks),
+                                 KMLPlacemark(Point(lat=4, lng=3), None,
+                                              None, None))
+                self.assertEqual(len(elements), 3)
+                self.assertIsNone(elements[0]())
+                self.assertIsNone(elements[1]())
+            with self.assertRaises(ET.ParseError):
+                next(placemarks)
+
+            # The main namespace is required
+            with open(fn, "w") as f:
+                f.write("<kml><Placemark /></kml>")
+            with self.assertRaises(AssertionError):
+                list(k.placemarks())
+
 
 class TestGeometry(unittest.TestCase):
     EXAMPLE_KML_POINT = """<?xml version="1.0" encoding="UTF-8"?>
@@ -719,6 +1044,8 @@ class TestGeometry(unittest.TestCase):
         self.assertEqual(p6.to_wkt(False), "(99.5 -90.0)")
 
         self.assertEqual(p6.wkt_type, "POINT")
+        self.assertEqual(repr(p6), "Point(lat=-90.0, lng=99.5)")
+        self.assertFalse(hasattr(p6, "__dict__"))
 
         # Test Geometry.wkt_literal
         self.assertEqual(p6.wkt_literal(),
@@ -734,6 +1061,11 @@ class TestGeometry(unittest.TestCase):
         l3 = LineString.from_kml_coords(
             "1.0,1.5,5890 2.0,2.5,1230 3.0,4.0,5670")
         self.assertEqual(l1, l3)
+        self.assertEqual(LineString.from_kml_coords(
+            "\n 1.0,1.5\t2.0,2.5,0\n\n  3.0,4.0,7 \n"), l1)
+        self.assertIsNone(LineString.from_kml_coords(" 1.0,1.5,0 "))
+        with self.assertRaises(IndexError):
+            LineString.from_kml_coords("1.0,1.5 2.0")
         l4 = self.from_kml_helper(self.EXAMPLE_KML_GX_TRACK)
         self.assertEqual(l1, l4)
         self.assertEqual(l1.to_wkt(), "LINESTRING(1.0 1.5, 2.0 2.5, 3.0 4.0)")
@@ -868,6 +1200,7 @@ class TestGeometry(unittest.TestCase):
         self.assertIsInstance(geocollect, GeometryCollection)
         if isinstance(geocollect, GeometryCollection):  # Type checker
             self.assertFalse(geocollect.homogeneous())
+            self.assertEqual(geocollect.wkt_type, "GEOMETRYCOLLECTION")
             exp_members: list[Polygon | LineString | Point] = [
                 polygon1, point1, point3, line2]
             # This test method's name is weird: from docs:
@@ -884,6 +1217,14 @@ class TestGeometry(unittest.TestCase):
                 wkt = wkt.replace(a, "X", 1)
             self.assertEqual(wkt, "GEOMETRYCOLLECTION(X, X, X, X)")
 
+        mixed = GeometryCollection([point3, line2, point3])
+        self.assertIsNone(mixed.homogeneous())
+        self.assertEqual(mixed.to_wkt(False),
+                         f"({point3.to_wkt()}, {line2.to_wkt()}, " +
+                         f"{point3.to_wkt()})")
+        mixed.members.clear()
+        self.assertIsNone(mixed.homogeneous())
+
     def test_kml_placemark(self):
         xpath = KMLXPathHelper()
         root = ET.fromstring(self.EXAMPLE_KML_PLACEMARKS)
@@ -945,6 +1286,23 @@ class TestGeometry(unittest.TestCase):
 
         places = root.findall(xpath.KML_PLACEMARK_XPATH)
         self.assertEqual(len(places), 2)
+        self.assertEqual(places[0].tag, xpath.KML_PLACEMARK_TAG)
+
+        # Tags and XPaths are only built once
+        self.assertIs(xpath.KML_POINT_XPATH, xpath.KML_POINT_XPATH)
+        self.assertEqual(
+            xpath.KML_POINT_XPATH,
+            f"./{xpath.KML_POINT_TAG}/{xpath.KML_COORDINATES_TAG}")
+        self.assertEqual(
+            xpath.KML_LINE_XPATH,
+            f"./{xpath.KML_LINE_TAG}/{xpath.KML_COORDINATES_TAG}")
+        self.assertEqual(xpath.KML_POLYGON_XPATH,
+                         f"./{xpath.KML_POLYGON_TAG}")
+        self.assertEqual(xpath.KML_MULTI_XPATH, f"./{xpath.KML_MULTI_TAG}")
+        self.assertEqual(xpath.KML_GX_TRACK_XPATH,
+                         f"./{xpath.KML_GX_TRACK_TAG}")
+        self.assertEqual(xpath.KML_GX_COORDS_XPATH,
+                         f"./{xpath.KML_GX_COORD_TAG}")
         for p in places:
             self.assertEqual(
                 len(p.findall(xpath.KML_NAME_XPATH)), 1)
@@ -1386,6 +1744,84 @@ class TestGTFS(unittest.TestCase):
 
         os.chdir(prog_dir)
 
+    @patch("gtfs2rdf.logger.info", lambda *_: None)
+    def test_gtfs_to_file_batches(self):
+        # Writing in small batches yields all triples
+        result = self.make_gtfs_and_get_result("minimal-gtfs")
+        with patch("gtfs2rdf.TO_FILE_BATCH_SIZE", 7):
+            result_batched = self.make_gtfs_and_get_result("minimal-gtfs")
+        self.assertEqual(result_batched.count(" .\n"), result.count(" .\n"))
+        self.assertGreater(result.count(" .\n"), 100)
+
+    def test_gtfs_table_dataset(self):
+        def make(zip_file: Optional[ZipFile]) -> GTFSTableDataset:
+            d = GTFSTableDataset(_dataset="Agency", _command=None,
+                                 _store_filename="agency.txt",
+                                 _primary_prefix="gtfs:agency_",
+                                 zip_filename="minimal-gtfs.zip",
+                                 zip_file=zip_file)
+            d.get_data()
+            return d
+
+        # The table is read from the zip, opened either by the dataset or
+        # by the caller
+        lines = list(make(None).content())
+        self.assertTrue(lines[0].startswith('"agency_id"'))
+        with ZipFile("minimal-gtfs.zip", "r") as zf:
+            self.assertEqual(list(make(zf).content()), lines)
+        self.assertFalse(Path("agency.txt").exists())
+        self.assertEqual(make(None), make(None))
+
+    def test_gtfs_date(self):
+        self.assertEqual(gtfs_date("20240131"), '"2024/01/31"^^xsd:date')
+        self.assertEqual(gtfs_date("2024"), '"2024"')
+
+    def test_replace_nalph(self):
+        self.assertEqual(replace_nalph("de:08311:6"),
+                         "de0x00003a083110x00003a6")
+        self.assertEqual(replace_nalph("A_shp"), "A_shp")
+        self.assertEqual(replace_nalph(""), "")
+        self.assertEqual(replace_nalph("ä b\u3000"), "ä0x000020b0x003000")
+
+    def test_shape_points(self):
+        self.assertEqual(shape_points(array("q", [1, 2, 5]), ["a", "b", "c"]),
+                         "a, b, c")
+        self.assertEqual(shape_points(array("q", [3, 1, 2]), ["a", "b", "c"]),
+                         "b, c, a")
+        self.assertEqual(shape_points(array("q", [1, 1]), ["b", "a"]), "a, b")
+        self.assertEqual(shape_points(array("q"), []), "")
+
+    @patch("gtfs2rdf.logger.info", lambda *_: None)
+    def test_gtfs_linestrings_multiple_shapes(self):
+        header = "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n"
+        feeds = {
+            # Consecutive shapes are emitted while reading shapes.txt
+            "consecutive": "A,1,2,1\nA,3,4,2\nB,5,6,2\nB,7,8,1\n",
+            # Interleaved shapes are collected until the end
+            "interleaved": "A,1,2,1\nB,7,8,1\nB,5,6,2\nA,3,4,2\n",
+        }
+        for feed, shapes in feeds.items():
+            with TemporaryDirectory() as d:
+                os.chdir(d)
+                with ZipFile("feed.zip", "w") as zf:
+                    zf.writestr("shapes.txt", header + shapes)
+                g = GTFSFeed(_feed=feed, _filename="feed.zip",
+                             _excludes=[], _add_linestrings=True)
+                g.get_all_data()
+                triples = list(g.rdf())
+                # The tables are read from the zip without extracting them
+                self.assertEqual(os.listdir(d), ["feed.zip"])
+                os.chdir(prog_dir)
+            wkt = [i for i, (_, _, o) in enumerate(triples)
+                   if "LINESTRING" in o]
+            self.assertEqual([triples[i][2] for i in wkt], [
+                '"LINESTRING(2 1, 4 3)"^^geo:wktLiteral',
+                '"LINESTRING(8 7, 6 5)"^^geo:wktLiteral'
+            ])
+            last_point = max(i for i, (_, p, _) in enumerate(triples)
+                             if p == "gtfs:shapePoint")
+            self.assertEqual(wkt[0] < last_point, feed == "consecutive")
+
     @patch("gtfs2rdf.logger.info", lambda *_: None)
     def test_gtfs_linestrings(self):
         os.chdir(Path(prog_dir, "test"))
@@ -1471,6 +1907,29 @@ class TestElection(unittest.TestCase):
         self.assertEqual(f2_content.count("election:"), 1)
         self.assertEqual(f2_content.count("POLYGON("), 1)
 
+        # Writing in small batches yields the same number of triples
+        e.aux_geo_callback = None
+        with patch("election2rdf.TO_FILE_BATCH_SIZE", 2), \
+                open(test_fn2, "w") as f1:
+            e.to_file(f1, None)
+        with open(test_fn2, "r") as f1:
+            self.assertEqual(f1.read().count(" .\n"),
+                             f1_content.count(" .\n"))
+
+        # KML datasets added after creation also receive the callback
+        late = KMLDataset(_dataset="late",
+                          _command="cat test/test.kml",
+                          _store_filename="test/test.kml",
+                          _primary_prefix="election:late_")
+        late.get_data()
+        e.datasets.append(late)
+        e.aux_geo_callback = aux_geo
+        aux_geo_.clear()
+        list(e.rdf())
+        self.assertIs(late.aux_geo_callback, aux_geo)
+        self.assertEqual(len(aux_geo_), 2)
+        self.assertTrue(aux_geo_[1][0].startswith("election:late_"))
+
     def test_load_config(self):
         os.chdir(Path(prog_dir, "test"))
         e = Election.load_from_config("election_mini.json")
@@ -1617,6 +2076,24 @@ class TestRunAsProgram(unittest.TestCase):
             os.chdir(d)
             kml2rdf_main(args("KML_Samples.kmz") + ["-z"])
 
+        # The KML file is extracted byte by byte, its encoding is left to
+        # the XML parser
+        with TemporaryDirectory() as d:
+            os.chdir(d)
+            kml = ('<?xml version="1.0" encoding="ISO-8859-1"?>' +
+                   '<kml xmlns="http://www.opengis.net/kml/2.2"><Placemark>' +
+                   '<name>Stra\xdfe</name><Point><coordinates>1,2' +
+                   '</coordinates></Point></Placemark></kml>'
+                   ).encode("latin-1")
+            with ZipFile("latin1.kmz", "w") as zf:
+                zf.writestr("doc.kml", kml)
+            kml2rdf_main(["-i", "latin1.kmz", "-d", "l", "-o", "l.ttl.bz2",
+                          "-p", "ex:", "-r", "http://example.com/", "-z"])
+            with open("latin1.kml", "rb") as f:
+                self.assertEqual(f.read(), kml)
+            with bz2.open("l.ttl.bz2", "rt") as f:
+                self.assertIn('rdfs:label "Stra\\u00dfe" .', f.read())
+
         with self.assertRaisesRegex(AssertionError,
                                     "Valid KMZ must contain exactly one " +
                                     "\\.kml file"):